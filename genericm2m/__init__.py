@@ -8,3 +8,5 @@ if PY3:
 else:
     unicode = unicode
     str = str
+
+default_app_config = 'genericm2m.apps.GenericM2MConfig'
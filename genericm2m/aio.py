@@ -0,0 +1,149 @@
+"""
+Coroutine counterparts of the related manager methods, for async views::
+
+    async def sidebar(request, pk):
+        food = await run_sync(Food.objects.get, pk=pk)
+        related = await food.related.ageneric_objects()
+
+The ORM of the Django versions supported here is synchronous only, so the
+methods run the regular ones in a worker thread: through asgiref's
+``sync_to_async`` when it is installed, which runs them on the caller's
+thread and connection under ``async_to_sync``, otherwise in a single thread
+dedicated to them.  The objects of the different content types fetched by
+ageneric_objects() are looked up in parallel, in threads of their own.  Only
+importable on Python 3.5+.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+
+# threads looking up generic objects in parallel when asgiref is missing,
+# each of which keeps a database connection open
+LOOKUP_THREADS = 4
+
+executor = None
+lookup_executor = None
+
+
+def get_executor():
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=1)
+    return executor
+
+
+def get_lookup_executor():
+    global lookup_executor
+    if lookup_executor is None:
+        lookup_executor = ThreadPoolExecutor(max_workers=LOOKUP_THREADS)
+    return lookup_executor
+
+
+def run_sync(func, *args, **kwargs):
+    """
+    Awaitable calling ``func`` with the given arguments in the worker thread
+    """
+    if sync_to_async is not None:
+        return sync_to_async(func)(*args, **kwargs)
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(get_executor(), partial(func, *args, **kwargs))
+
+
+def run_parallel(func, *args, **kwargs):
+    """
+    Awaitable calling ``func`` with the given arguments in a thread of its
+    own, with its own database connection, which does not see the changes
+    of transactions left open elsewhere
+    """
+    if sync_to_async is not None:
+        return sync_to_async(func, thread_sensitive=False)(*args, **kwargs)
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(get_lookup_executor(),
+                                partial(func, *args, **kwargs))
+
+
+def get_generic_rows(queryset, model=None):
+    """
+    The (row pk, content type id, object id) tuples of ``queryset`` whose
+    content type is ``model`` or a subclass, as a list
+    """
+    if model:
+        queryset = queryset.filter_generic_models(model)
+    gfk_field = queryset.get_gfk()
+    return queryset.filter_generic_rows(queryset.values_list(
+        'pk', '%s_id' % gfk_field.ct_field, gfk_field.fk_field), model)
+
+
+class AsyncRelatedManagerMixin(object):
+    """
+    Mixed into the related managers built by RelatedObjectsDescriptor
+    """
+    async def aconnect(self, obj, **kwargs):
+        return await run_sync(self.connect, obj, **kwargs)
+
+    async def aadd(self, *objs, **kwargs):
+        return await run_sync(self.add, *objs, **kwargs)
+
+    async def aremove(self, *objs):
+        return await run_sync(self.remove, *objs)
+
+    async def aclear(self):
+        return await run_sync(self.clear)
+
+    async def arelated_to(self):
+        """
+        The connections to this instance, as a list
+        """
+        return await run_sync(lambda: list(self.related_to()))
+
+    async def asymmetrical(self, union=False):
+        """
+        The connections from or to this instance, as a list
+        """
+        return await run_sync(lambda: list(self.symmetrical(union)))
+
+    async def ageneric_objects(self, model=None, missing='raise', orphans=None,
+                               querysets=None, parallel=True):
+        """
+        Like generic_objects(), but once the connections are read, the objects
+        of each content type are looked up in parallel with run_parallel().
+        Pass parallel=False to look them up one after another with run_sync()
+        instead, e.g. when they were created in a transaction still open.
+        """
+        # genericm2m.models imports this module
+        from genericm2m.models import get_concrete_models
+
+        queryset = self.all()
+        queryset.check_missing_policy(missing)
+        if model:
+            model = get_concrete_models(model)
+        rows = await run_sync(get_generic_rows, queryset, model)
+
+        ctypes_and_fks = {}
+        for pk, ctype_id, obj_id in rows:
+            ctypes_and_fks.setdefault(ctype_id, []).append(obj_id)
+        ctype_ids = list(ctypes_and_fks)
+
+        lookup = queryset.get_generic_objects_for_type
+        if parallel and len(ctype_ids) > 1:
+            results = await asyncio.gather(*[
+                run_parallel(lookup, ctype_id, ctypes_and_fks[ctype_id], querysets)
+                for ctype_id in ctype_ids
+            ])
+        else:
+            results = []
+            for ctype_id in ctype_ids:
+                results.append(await run_sync(
+                    lookup, ctype_id, ctypes_and_fks[ctype_id], querysets))
+
+        # the lookups cached the models of the content types, so matching
+        # the rows runs no query
+        gfk_objects = dict(zip(ctype_ids, results))
+        return list(queryset.match_generic_objects(
+            rows, gfk_objects, model, missing, orphans))
@@ -0,0 +1,18 @@
+from django.apps import AppConfig
+from django.db.models import signals
+
+
+class GenericM2MConfig(AppConfig):
+    name = 'genericm2m'
+    verbose_name = 'Generic many-to-many'
+
+    def ready(self):
+        from django.contrib.contenttypes.models import ContentType
+        from genericm2m.models import content_types
+
+        content_types.prepare()
+        for signal in (signals.post_save, signals.post_delete):
+            signal.connect(content_types.clear, sender=ContentType, weak=False,
+                           dispatch_uid='genericm2m-content-types')
+        signals.post_migrate.connect(content_types.clear, weak=False,
+                                     dispatch_uid='genericm2m-content-types')
@@ -0,0 +1,262 @@
+"""
+Benchmarks for the hot paths of the descriptor and related managers, run with
+
+    python runtests.py bench [postgres] [--sizes=1000,10000] [--repeat=5]
+                             [--save=FILE] [--compare=FILE] [--threshold=1.5]
+
+The test models are seeded with each number of connections, then every
+benchmark reports the queries it ran, its best wall time over ``--repeat``
+runs and the peak memory allocated while it ran, measured in a separate run
+so that tracing does not slow down the timed ones.  ``--save`` writes the
+results to a JSON file which ``--compare`` later reads back as the baseline,
+failing when a benchmark runs more queries than before, or takes more than
+``--threshold`` times the time or memory.
+"""
+import json
+import random
+from collections import OrderedDict
+from itertools import chain, islice
+from timeit import default_timer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from django.db import connection, transaction
+from django.test.runner import DiscoverRunner
+from django.test.utils import CaptureQueriesContext
+
+from genericm2m.models import RelatedObject, content_types
+from genericm2m.genericm2m_tests.models import (
+    Food, Beverage, Person, Note, AnotherRelatedObject
+)
+
+
+DEFAULT_SIZES = (1000, 10000)
+
+DEFAULT_REPEAT = 5
+
+# number of connections the benchmarks add and remove at once
+BATCH = 100
+
+
+def seed(size):
+    """
+    Create ``size`` connections between foods, beverages and people, a tenth
+    of them from a single "hub" food and a tenth of them from notes.  Returns
+    the hub, the most connected-to beverage and a note.
+    """
+    rand = random.Random(size)
+    count = max(size // 50, 10)
+    foods = Food.objects.bulk_create(
+        [Food(name='food %s' % i) for i in range(count)])
+    beverages = Beverage.objects.bulk_create(
+        [Beverage(name='beverage %s' % i) for i in range(count)])
+    people = Person.objects.bulk_create(
+        [Person(name='person %s' % i) for i in range(count)])
+    notes = Note.objects.bulk_create(
+        [Note(content='note %s' % i) for i in range(count)])
+
+    if foods[0].pk is None:
+        # bulk_create() only sets primary keys on PostgreSQL
+        foods, beverages, people, notes = [
+            list(model.objects.order_by('pk'))
+            for model in (Food, Beverage, Person, Note)
+        ]
+
+    hub, popular = foods[0], beverages[0]
+    targets = beverages + people
+    food_id, note_id = content_types.get_ids([Food, Note])
+
+    def edge(model, parent_type_id, parent, obj):
+        return model(parent_type_id=parent_type_id, parent_id=parent.pk,
+                     object_type_id=content_types.get_id(obj), object_id=obj.pk)
+
+    # the edges are generated as they are inserted, never all at once
+    bulk_create(RelatedObject, chain(
+        [edge(RelatedObject, food_id, hub, popular)],
+        (edge(RelatedObject, food_id, hub, rand.choice(targets))
+         for i in range(size // 10 - 1)),
+        (edge(RelatedObject, food_id, rand.choice(foods[1:]),
+              rand.choice([popular] + targets))
+         for i in range(size - size // 5)),
+    ))
+
+    bulk_create(AnotherRelatedObject, (
+        edge(AnotherRelatedObject, note_id, rand.choice(notes), rand.choice(targets))
+        for i in range(size // 10)
+    ))
+    return hub, popular, notes[0]
+
+
+def bulk_create(model, objs, chunk_size=1000):
+    # insert ``chunk_size`` objects of the iterable at a time, with fewer
+    # rows per INSERT if the backend requires it
+    objs = iter(objs)
+    while True:
+        chunk = list(islice(objs, chunk_size))
+        if not chunk:
+            break
+        batch_size = connection.ops.bulk_batch_size(model._meta.concrete_fields, chunk)
+        model.objects.bulk_create(chunk, batch_size=max(min(batch_size, chunk_size), 1))
+
+
+def get_benchmarks(hub, popular, note):
+    """
+    The benchmarks, as an ordered dictionary of name -> function.  They run
+    in order, as some of them change the connections of the hub.
+    """
+    new_people = []
+
+    def setup():
+        new_people.extend(Person.objects.bulk_create(
+            [Person(name='new %s' % i) for i in range(BATCH * 2)]))
+        if new_people[0].pk is None:
+            new_people[:] = list(Person.objects.order_by('-pk')[:BATCH * 2])
+
+    def connect():
+        for person in new_people[:BATCH]:
+            hub.related.connect(person)
+
+    def add():
+        hub.related.add(*[RelatedObject(object=person)
+                          for person in new_people[BATCH:]], bulk=True)
+
+    def generic_objects():
+        hub.related.generic_objects()
+
+    def note_generic_objects():
+        note.related.generic_objects()
+
+    def related_to():
+        list(popular.related.related_to())
+
+    def symmetrical():
+        list(hub.related.symmetrical())
+
+    def remove():
+        hub.related.remove(*hub.related.all()[:BATCH])
+
+    def clear():
+        hub.related.clear()
+
+    setup()
+    return OrderedDict([
+        ('connect', connect),
+        ('add', add),
+        ('generic_objects', generic_objects),
+        ('note_generic_objects', note_generic_objects),
+        ('related_to', related_to),
+        ('symmetrical', symmetrical),
+        ('remove', remove),
+        ('clear', clear),
+    ])
+
+
+def measure(func, repeat=DEFAULT_REPEAT):
+    """
+    Times ``repeat`` runs of ``func``, each rolled back, then runs it once
+    more under tracemalloc.  The changes of that last run are kept, as the
+    following benchmarks build on them.
+    """
+    times = []
+    for i in range(repeat):
+        with transaction.atomic():
+            with CaptureQueriesContext(connection) as ctx:
+                start = default_timer()
+                func()
+                times.append(default_timer() - start)
+            transaction.set_rollback(True)
+
+    peak = None
+    if tracemalloc:
+        tracemalloc.start()
+    func()
+    if tracemalloc:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {
+        'queries': len(ctx.captured_queries),
+        'time': min(times),
+        'memory': peak,
+    }
+
+
+def run(sizes, repeat=DEFAULT_REPEAT):
+    """
+    Runs the benchmarks for each number of connections in ``sizes``, rolling
+    back the seeded data afterwards.  Returns a dictionary mapping
+    "size:benchmark" to its measurements.
+    """
+    results = OrderedDict()
+    for size in sizes:
+        with transaction.atomic():
+            hub, popular, note = seed(size)
+            for name, func in get_benchmarks(hub, popular, note).items():
+                results['%s:%s' % (size, name)] = measure(func, repeat)
+            transaction.set_rollback(True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns the descriptions of the regressions of ``results`` against
+    ``baseline``
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        if result['queries'] > base['queries']:
+            regressions.append('%s: %s queries, was %s' % (
+                key, result['queries'], base['queries']))
+        for metric in ('time', 'memory'):
+            if result[metric] and base[metric] and \
+                    result[metric] > base[metric] * threshold:
+                regressions.append('%s: %s %.2fx the baseline' % (
+                    key, metric, result[metric] / float(base[metric])))
+    return regressions
+
+
+def report(results, stream):
+    stream.write('%-30s %8s %12s %12s\n' % (
+        'benchmark', 'queries', 'time (ms)', 'peak (KiB)'))
+    for key, result in results.items():
+        memory = '-' if result['memory'] is None else '%.1f' % (result['memory'] / 1024.0)
+        stream.write('%-30s %8s %12.2f %12s\n' % (
+            key, result['queries'], result['time'] * 1000, memory))
+
+
+def main(args, stream):
+    """
+    Entry point used by runtests.py, returns the number of regressions
+    """
+    options = dict(arg[2:].split('=', 1) for arg in args if arg.startswith('--'))
+    sizes = DEFAULT_SIZES
+    if 'sizes' in options:
+        sizes = [int(size) for size in options['sizes'].split(',')]
+    repeat = max(int(options.get('repeat', DEFAULT_REPEAT)), 1)
+
+    runner = DiscoverRunner(verbosity=0)
+    old_config = runner.setup_databases()
+    try:
+        results = run(sizes, repeat)
+    finally:
+        runner.teardown_databases(old_config)
+    report(results, stream)
+
+    if 'save' in options:
+        with open(options['save'], 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+    regressions = []
+    if 'compare' in options:
+        with open(options['compare']) as fh:
+            baseline = json.load(fh)
+        regressions = compare(results, baseline,
+                              float(options.get('threshold', 1.5)))
+        for regression in regressions:
+            stream.write('REGRESSION %s\n' % regression)
+    return len(regressions)
@@ -5,7 +5,11 @@ except ImportError:
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
 
-from genericm2m.models import RelatedObjectsDescriptor
+import uuid
+
+from genericm2m.models import (
+    BaseGFKRelatedObject, CharGFKRelatedObject, RelatedObjectsDescriptor
+)
 
 
 class RelatedBeverage(models.Model):
@@ -35,6 +39,11 @@ class Beverage(models.Model):
         return self.name
 
 
+class Drink(Beverage):
+    class Meta:
+        proxy = True
+
+
 class Person(models.Model):
     name = models.CharField(max_length=255)
 
@@ -73,3 +82,53 @@ class Note(models.Model):
     content = models.TextField()
 
     related = RelatedObjectsDescriptor(AnotherRelatedObject)
+
+
+class StringRelatedObject(CharGFKRelatedObject):
+    class Meta(CharGFKRelatedObject.Meta):
+        ordering = ('id',)
+
+
+class Tag(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    name = models.CharField(max_length=255)
+
+    related = RelatedObjectsDescriptor(StringRelatedObject)
+
+    def __unicode__(self):
+        return self.name
+
+
+class Comment(models.Model):
+    content = models.TextField()
+
+    related = RelatedObjectsDescriptor(StringRelatedObject)
+
+
+class CachedRelatedObject(BaseGFKRelatedObject):
+    class Meta(BaseGFKRelatedObject.Meta):
+        ordering = ('id',)
+
+
+class Article(models.Model):
+    title = models.CharField(max_length=255)
+
+    related = RelatedObjectsDescriptor(CachedRelatedObject, cache=True)
+
+    def __unicode__(self):
+        return self.title
+
+
+class CountedRelatedObject(BaseGFKRelatedObject):
+    class Meta(BaseGFKRelatedObject.Meta):
+        ordering = ('id',)
+
+
+class Recipe(models.Model):
+    name = models.CharField(max_length=255)
+
+    related = RelatedObjectsDescriptor(CountedRelatedObject, counters=True,
+                                       cascade=True)
+
+    def __unicode__(self):
+        return self.name
@@ -1,9 +1,14 @@
 from django.contrib.contenttypes.models import ContentType
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+
+import sys
+import unittest
 
 from genericm2m.models import RelatedObject, RelatedObjectsDescriptor, GFKOptimizedQuerySet
 from genericm2m.genericm2m_tests.models import (
-    Food, Beverage, Person, RelatedBeverage, Boring, AnotherRelatedObject, Note
+    Food, Beverage, Person, RelatedBeverage, Boring, AnotherRelatedObject, Note,
+    StringRelatedObject, Tag, Comment, Article,
+    CountedRelatedObject, Recipe, Drink
 )
 
 
@@ -432,3 +437,972 @@ class RelationsTestCase(TestCase):
         related = self.pizza.related.all()
         objects = related.generic_objects(Person)
         self.assertEqual(objects, [self.mario])
+
+    def test_manager_caching(self):
+        """
+        The manager class is built once per descriptor and the manager itself
+        is memoized on each instance until its primary key changes
+        """
+        self.assertTrue(self.pizza.related is self.pizza.related)
+        self.assertTrue(type(self.pizza.related) is type(self.sandwich.related))
+        self.assertFalse(self.pizza.related is self.sandwich.related)
+        self.assertEqual(self.pizza.related.instance, self.pizza)
+
+        # the reverse manager class is cached separately
+        self.pizza.related.connect(self.soda)
+        self.assertRelatedEqual(self.soda.related.related_to(), (
+            (self.pizza, self.soda),
+        ))
+        self.assertEqual(len(Beverage.related.manager_classes), 2)
+
+        # managers created before an instance is saved are not reused
+        waffle = Food(name='waffle')
+        unsaved = waffle.related
+        waffle.save()
+        self.assertFalse(waffle.related is unsaved)
+        waffle.related.connect(self.milk)
+        self.assertRelatedEqual(waffle.related.all(), (
+            (waffle, self.milk),
+        ))
+
+        # memoized managers do not prevent instances from being pickled
+        import pickle
+        pizza = pickle.loads(pickle.dumps(self.pizza))
+        self.assertEqual(pizza, self.pizza)
+        self.assertRelatedEqual(pizza.related.all(), (
+            (self.pizza, self.soda),
+        ))
+
+    def test_connect_many(self):
+        """
+        Connecting many objects at once costs one query per content type to
+        find existing connections plus a single INSERT for the missing ones
+        """
+        existing = self.pizza.related.connect(self.soda)
+
+        with self.assertNumQueries(5):
+            connections = self.pizza.related.connect_many(
+                [self.beer, self.mario, self.soda, self.milk, self.beer])
+
+        self.assertEqual(len(connections), 5)
+        self.assertEqual(connections[2], existing)
+        self.assertEqual(connections[0], connections[4])
+        self.assertEqual([c.object for c in connections], [
+            self.beer, self.mario, self.soda, self.milk, self.beer])
+        self.assertTrue(all(c.pk for c in connections))
+        self.assertEqual(RelatedObject.objects.count(), 4)
+
+        # nothing new to create, so only the lookups are issued
+        with self.assertNumQueries(2):
+            self.pizza.related.connect_many([self.beer, self.mario])
+        self.assertEqual(RelatedObject.objects.count(), 4)
+
+        # extra attributes are matched and stored like with connect()
+        connections = self.sandwich.related.connect_many(
+            [self.milk, self.table], alias='breakfast')
+        self.assertEqual([c.alias for c in connections], ['breakfast', 'breakfast'])
+        self.assertRelatedEqual(self.sandwich.related.filter(alias='breakfast').order_by('id'), (
+            (self.sandwich, self.milk),
+            (self.sandwich, self.table),
+        ))
+
+        # works with non-generic through models as well
+        connections = self.pizza.related_beverages.connect_many([self.soda, self.beer])
+        self.assertEqual([c.beverage for c in connections], [self.soda, self.beer])
+        self.assertRaises(TypeError, self.pizza.related_beverages.connect_many, [self.mario])
+
+    def test_bulk_add(self):
+        """
+        add(bulk=True) writes unsaved objects with one INSERT and moves saved
+        ones with one UPDATE
+        """
+        moved = self.cereal.related.connect(self.soda)
+        new_objs = [RelatedObject(object=self.beer), RelatedObject(object=self.mario)]
+
+        with self.assertNumQueries(2):
+            self.pizza.related.add(moved, *new_objs, bulk=True)
+
+        self.assertRelatedEqual(self.pizza.related.order_by('id'), (
+            (self.pizza, self.soda),
+            (self.pizza, self.beer),
+            (self.pizza, self.mario),
+        ))
+        self.assertRelatedEqual(self.cereal.related.all(), ())
+
+        # by default each object is saved, along with its other changes
+        moved.alias = 'moved'
+        new_obj = RelatedObject(object=self.milk)
+        self.sandwich.related.add(moved, new_obj)
+        self.assertIsNotNone(new_obj.pk)
+        self.assertRelatedEqual(self.sandwich.related.order_by('id'), (
+            (self.sandwich, self.soda),
+            (self.sandwich, self.milk),
+        ))
+        self.assertEqual(RelatedObject.objects.get(pk=moved.pk).alias, 'moved')
+        self.sandwich.related.remove(new_obj)
+        self.assertRaises(TypeError, self.sandwich.related.add, self.pizza)
+
+    def test_remove_many(self):
+        """
+        remove() checks membership with a single query and refuses to delete
+        anything if one of the objects is not related
+        """
+        soda_rel, beer_rel, mario_rel = self.pizza.related.connect_many(
+            [self.soda, self.beer, self.mario])
+        stray = self.cereal.related.connect(self.milk)
+
+        self.assertRaises(RelatedObject.DoesNotExist,
+                          self.pizza.related.remove, soda_rel, stray)
+        self.assertRaises(RelatedObject.DoesNotExist,
+                          self.pizza.related.remove, RelatedObject(object=self.soda))
+        # the connected objects themselves are not connections
+        self.assertRaises(TypeError, self.pizza.related.remove, self.soda)
+        self.assertEqual(RelatedObject.objects.count(), 4)
+
+        with self.assertNumQueries(2):
+            self.pizza.related.remove(soda_rel, beer_rel)
+        self.assertRelatedEqual(self.pizza.related.all(), (
+            (self.pizza, self.mario),
+        ))
+        self.assertRelatedEqual(self.cereal.related.all(), (
+            (self.cereal, self.milk),
+        ))
+
+    def test_disconnect(self):
+        """
+        disconnect() removes connections by the connected object, issuing one
+        DELETE per content type
+        """
+        self.pizza.related.connect_many([self.soda, self.beer, self.mario, self.sam])
+        self.cereal.related.connect_many([self.soda, self.mario])
+
+        with self.assertNumQueries(2):
+            deleted = self.pizza.related.disconnect(self.soda, self.mario, self.milk)
+        self.assertEqual(deleted, 2)
+
+        self.assertEqual(sorted(o.name for o in self.pizza.related.all().generic_objects()),
+                         ['beer', 'sam'])
+        self.assertEqual(sorted(o.name for o in self.cereal.related.all().generic_objects()),
+                         ['mario', 'soda'])
+
+        self.pizza.related_beverages.connect_many([self.soda, self.beer])
+        self.assertEqual(self.pizza.related_beverages.disconnect(self.beer), 1)
+        self.assertRelatedEqual(self.pizza.related_beverages.all(), (
+            (self.pizza, self.soda),
+        ), 'food', 'beverage')
+
+    def test_prefetch_related(self):
+        """
+        prefetch_related() loads the connections of many instances with one
+        query and the connected objects with one query per content type
+        """
+        self.pizza.related.connect_many([self.soda, self.mario])
+        self.sandwich.related.connect_many([self.beer, self.milk, self.table])
+        self.pizza.related_beverages.connect(self.beer)
+
+        with self.assertNumQueries(5):
+            foods = list(Food.objects.order_by('id').prefetch_related('related'))
+        pizza, sandwich, cereal = foods
+
+        with self.assertNumQueries(0):
+            self.assertEqual(sorted(o.name for o in pizza.related.all().generic_objects()),
+                             ['mario', 'soda'])
+            self.assertEqual(sorted(o.name for o in sandwich.related.all().generic_objects()),
+                             ['beer', 'milk', 'table'])
+            self.assertEqual(sandwich.related.all().generic_objects(Boring), [self.table])
+            self.assertEqual(cereal.related.all().generic_objects(), [])
+
+        # non-generic through models work too
+        with self.assertNumQueries(2):
+            foods = list(Food.objects.order_by('id').prefetch_related('related_beverages'))
+        with self.assertNumQueries(0):
+            self.assertEqual(len(foods[0].related_beverages.all()), 1)
+            self.assertEqual(len(foods[1].related_beverages.all()), 0)
+
+        # custom querysets can be passed with Prefetch
+        from django.db.models import Prefetch
+        self.pizza.related.connect(self.milk, alias='dairy')
+        pizza = Food.objects.prefetch_related(Prefetch(
+            'related', queryset=RelatedObject.objects.filter(alias='dairy'))).get(pk=self.pizza.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual([c.alias for c in pizza.related.all()], ['dairy'])
+
+        # changing the connections discards the prefetched rows
+        pizza = Food.objects.prefetch_related('related').get(pk=self.pizza.pk)
+        pizza.related.connect(self.beer)
+        self.assertEqual(pizza.related.count(), 4)
+
+    def test_iter_generic_objects(self):
+        """
+        iter_generic_objects() yields the same objects as generic_objects(),
+        resolving them one chunk at a time
+        """
+        self.pizza.related.connect_many([
+            self.soda, self.mario, self.beer, self.table, self.milk, self.sam])
+        related = self.pizza.related.order_by('id')
+        expected = [self.soda, self.mario, self.beer, self.table, self.milk, self.sam]
+
+        # one query for the rows, then one per content type in each chunk
+        with self.assertNumQueries(7):
+            objects = list(related.iter_generic_objects(chunk_size=2))
+        self.assertEqual(objects, expected)
+        self.assertEqual(related.generic_objects(), expected)
+
+        self.assertEqual(list(related.iter_generic_objects(chunk_size=4)), expected)
+        self.assertEqual(list(related.iter_generic_objects(Person, chunk_size=2)),
+                         [self.mario, self.sam])
+        self.assertEqual(list(self.cereal.related.all().iter_generic_objects()), [])
+
+    def test_generic_objects_model_filter(self):
+        """
+        Filtering generic objects by model restricts the content types in SQL
+        so that only the matching objects are fetched
+        """
+        self.pizza.related.connect_many([self.beer, self.mario, self.soda, self.table])
+        related = self.pizza.related.order_by('id')
+
+        with self.assertNumQueries(2):
+            self.assertEqual(related.generic_objects(Beverage), [self.beer, self.soda])
+
+        with self.assertNumQueries(3):
+            self.assertEqual(related.generic_objects([Person, Boring]),
+                             [self.mario, self.table])
+
+        self.assertEqual(list(related.iter_generic_objects((Beverage, Boring))),
+                         [self.beer, self.soda, self.table])
+        self.assertEqual(related.filter_generic_models(Person).count(), 1)
+        self.assertEqual(related.generic_objects(Note), [])
+
+        # proxies match the objects of their concrete model
+        with self.assertNumQueries(2):
+            self.assertEqual(related.generic_objects(Drink), [self.beer, self.soda])
+        self.assertEqual(list(related.iter_generic_objects([Drink, Person])),
+                         [self.beer, self.mario, self.soda])
+
+        # sliced querysets cannot be filtered, the rows are filtered instead
+        self.assertEqual(related[:3].generic_objects(Beverage), [self.beer, self.soda])
+        self.assertEqual(list(related[1:].iter_generic_objects(Beverage)), [self.soda])
+        self.assertEqual(
+            [obj for rel_obj, obj in related[:2].generic_objects(Person, pairs=True)],
+            [self.mario])
+
+    def test_generic_objects_missing(self):
+        """
+        Rows pointing at deleted objects are handled according to the
+        `missing` policy and can be collected for cleanup in the same pass
+        """
+        soda_rel, mario_rel, beer_rel = self.pizza.related.connect_many(
+            [self.soda, self.mario, self.beer])
+        Beverage.objects.filter(pk=self.soda.pk).delete()
+        related = self.pizza.related.order_by('id')
+
+        self.assertRaises(Beverage.DoesNotExist, related.generic_objects)
+        self.assertRaises(Beverage.DoesNotExist, list, related.iter_generic_objects())
+        self.assertRaises(ValueError, related.generic_objects, missing='ignore')
+
+        orphans = []
+        self.assertEqual(related.generic_objects(missing='skip', orphans=orphans),
+                         [self.mario, self.beer])
+        self.assertEqual(orphans, [soda_rel.pk])
+
+        self.assertEqual(related.generic_objects(missing='none'),
+                         [None, self.mario, self.beer])
+        self.assertEqual(related.generic_objects(Person, missing='none'), [self.mario])
+        self.assertEqual(related.generic_objects(Beverage, missing='none'), [None, self.beer])
+
+        orphans = []
+        self.assertEqual(list(related.iter_generic_objects(missing='none', orphans=orphans)),
+                         [None, self.mario, self.beer])
+        self.assertEqual(orphans, [soda_rel.pk])
+
+        # prefetched rows are handled the same way
+        pizza = Food.objects.prefetch_related('related').get(pk=self.pizza.pk)
+        orphans = []
+        self.assertEqual(
+            sorted(o.name for o in pizza.related.all().generic_objects(missing='skip', orphans=orphans)),
+            ['beer', 'mario'])
+        self.assertEqual(orphans, [soda_rel.pk])
+
+    def test_composite_indexes(self):
+        """
+        The connection tables are indexed on (content type, id) for both ends
+        """
+        from django.db import connection
+        cursor = connection.cursor()
+        constraints = connection.introspection.get_constraints(
+            cursor, RelatedObject._meta.db_table)
+        indexes = [c['columns'] for c in constraints.values() if c['index']]
+        self.assertTrue(['parent_type_id', 'parent_id'] in indexes)
+        self.assertTrue(['object_type_id', 'object_id'] in indexes)
+
+    def test_string_object_ids(self):
+        """
+        Through models storing object ids as strings can connect objects with
+        integer and UUID primary keys, and generic lookups match the keys up
+        """
+        tag_a = Tag.objects.create(name='a')
+        tag_b = Tag.objects.create(name='b')
+        comment = Comment.objects.create(content='nice')
+
+        tag_a.related.connect(comment)
+        tag_a.related.connect_many([tag_b, comment])
+        comment.related.connect(tag_a)
+
+        self.assertEqual(StringRelatedObject.objects.count(), 3)
+        self.assertEqual(tag_a.related.all().generic_objects(), [comment, tag_b])
+        self.assertEqual(list(tag_a.related.all().iter_generic_objects()), [comment, tag_b])
+        self.assertEqual(comment.related.all().generic_objects(), [tag_a])
+        self.assertEqual(comment.related.related_to().generic_objects(), [tag_a])
+        self.assertEqual(tag_b.related.related_to().generic_objects(), [tag_a])
+
+        tags = list(Tag.objects.filter(pk=tag_a.pk).prefetch_related('related'))
+        with self.assertNumQueries(0):
+            self.assertEqual(tags[0].related.all().generic_objects(), [comment, tag_b])
+
+        self.assertEqual(tag_a.related.disconnect(comment), 1)
+        self.assertEqual(tag_a.related.all().generic_objects(), [tag_b])
+
+    def test_cached_connections(self):
+        """
+        Descriptors with a cache store the connections of each instance and
+        discard them whenever the connections change
+        """
+        from django.core.cache import cache
+        cache.clear()
+
+        article = Article.objects.create(title='lunch')
+        other = Article.objects.create(title='dinner')
+        article.related.connect(self.pizza)
+        article.related.connect(self.soda)
+
+        with self.assertNumQueries(3):
+            self.assertEqual(article.related.generic_objects(), [self.pizza, self.soda])
+
+        # the connections come from the cache, only the objects are fetched
+        with self.assertNumQueries(2):
+            self.assertEqual(article.related.generic_objects(), [self.pizza, self.soda])
+        with self.assertNumQueries(1):
+            self.assertEqual(article.related.generic_objects(Beverage), [self.soda])
+        with self.assertNumQueries(0):
+            self.assertEqual(article.related.generic_objects(Person), [])
+
+        # another instance of the same object shares the cache
+        same_article = Article.objects.get(pk=article.pk)
+        with self.assertNumQueries(2):
+            same_article.related.generic_objects()
+
+        article.related.connect(self.mario)
+        self.assertEqual(article.related.generic_objects(),
+                         [self.pizza, self.soda, self.mario])
+
+        article.related.connect_many([self.beer, self.table])
+        self.assertEqual(article.related.generic_objects(),
+                         [self.pizza, self.soda, self.mario, self.beer, self.table])
+
+        article.related.disconnect(self.soda, self.table)
+        self.assertEqual(article.related.generic_objects(),
+                         [self.pizza, self.mario, self.beer])
+
+        rel = article.related.all().filter_generic_models(Beverage).get()
+        article.related.remove(rel)
+        self.assertEqual(article.related.generic_objects(), [self.pizza, self.mario])
+
+        # moving a connection to another instance invalidates both
+        self.assertEqual(other.related.generic_objects(), [])
+        other.related.add(article.related.all().filter_generic_models(Person).get())
+        self.assertEqual(article.related.generic_objects(), [self.pizza])
+        self.assertEqual(other.related.generic_objects(), [self.mario])
+
+        article.related.clear()
+        self.assertEqual(article.related.generic_objects(), [])
+
+        # the reverse side is never read from the cache
+        self.assertEqual(self.mario.related.related_to().count(), 0)
+        self.assertRaises(ValueError, RelatedObjectsDescriptor,
+                          RelatedBeverage, 'food', 'beverage', cache=True)
+
+    def test_counts_and_existence(self):
+        """
+        Counting and existence checks run a single query without loading the
+        connections
+        """
+        self.pizza.related.connect_many([self.soda, self.beer, self.mario, self.table])
+        self.soda.related.connect(self.pizza)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.pizza.related.count_by_type(), {
+                Beverage: 2, Person: 1, Boring: 1,
+            })
+        self.assertEqual(self.cereal.related.count_by_type(), {})
+
+        with self.assertNumQueries(2):
+            self.assertTrue(self.pizza.related.is_connected(self.soda))
+            self.assertFalse(self.pizza.related.is_connected(self.milk))
+        self.assertFalse(self.soda.related.is_connected(self.mario))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(sorted(self.pizza.related.connected_ids(Beverage)),
+                             [self.soda.pk, self.beer.pk])
+        self.assertEqual(self.pizza.related.connected_ids(Food), [])
+
+        self.pizza.related_beverages.connect(self.milk)
+        self.assertEqual(self.pizza.related_beverages.count_by_type(), {Beverage: 1})
+        self.assertTrue(self.pizza.related_beverages.is_connected(self.milk))
+        self.assertEqual(self.pizza.related_beverages.connected_ids(Beverage), [self.milk.pk])
+        self.assertEqual(self.pizza.related_beverages.connected_ids(Person), [])
+
+    def test_traversal(self):
+        """
+        Multi-hop traversal issues one query per hop and direction, or a single
+        recursive query
+        """
+        # pizza -> soda -> beer -> mario -> pizza (a cycle), sandwich -> soda
+        self.pizza.related.connect(self.soda)
+        self.soda.related.connect(self.beer)
+        self.beer.related.connect(self.mario)
+        self.mario.related.connect(self.pizza)
+        self.sandwich.related.connect(self.soda)
+        self.beer.related.connect(self.table)
+
+        key = lambda obj: (ContentType.objects.get_for_model(obj).pk, obj.pk)
+
+        with self.assertNumQueries(2):
+            reached = Food.related.reachable_keys([self.pizza], depth=2)
+        self.assertEqual(reached, {key(self.soda): 1, key(self.beer): 2})
+
+        # four hops until the cycle closes, then one query per content type
+        with self.assertNumQueries(7):
+            objects = Food.related.traverse([self.pizza], depth=10)
+        self.assertEqual(objects[:2], [self.soda, self.beer])
+        self.assertEqual(sorted(o.name for o in objects[2:]), ['mario', 'table'])
+
+        self.assertEqual(Food.related.traverse([self.pizza], depth=1, direction='reverse'),
+                         [self.mario])
+        self.assertEqual(
+            sorted(o.name for o in Food.related.traverse([self.soda], depth=1, direction='both')),
+            ['beer', 'pizza', 'sandwich'])
+        self.assertEqual(Food.related.traverse([self.cereal], depth=3), [])
+        self.assertEqual(Food.related.traverse([], depth=3), [])
+
+        for direction in ('forward', 'reverse'):
+            for depth in (1, 2, 5):
+                with self.assertNumQueries(1):
+                    cte = Food.related.reachable_keys(
+                        [self.pizza, self.sandwich], depth, direction, use_cte=True)
+                self.assertEqual(
+                    cte, Food.related.reachable_keys([self.pizza, self.sandwich], depth, direction))
+
+        # too many start objects for one compound query are walked in batches
+        foods = [Food.objects.create(name='food %s' % i) for i in range(600)]
+        foods[-1].related.connect(self.pizza)
+        with self.assertNumQueries(2):
+            cte = Food.related.reachable_keys(foods, 2, use_cte=True)
+        self.assertEqual(cte, Food.related.reachable_keys(foods, 2))
+        with self.assertNumQueries(6):
+            Food.related.reachable_keys(foods, 2, use_cte=True, batch_size=100)
+
+        self.assertRaises(ValueError, Food.related.reachable_keys, [self.pizza], 1, 'sideways')
+        self.assertRaises(TypeError, Food.related_beverages.traverse, [self.pizza])
+
+    def test_symmetrical_union(self):
+        """
+        The UNION flavor of symmetrical() returns the same connections as the
+        OR + DISTINCT one, and symmetrical_objects() the other ends
+        """
+        self.pizza.related.connect(self.soda)
+        self.pizza.related.connect(self.beer)
+        self.sandwich.related.connect(self.soda)
+        self.mario.related.connect(self.soda)
+        self.soda.related.connect(self.pizza)
+        self.soda.related.connect(self.table)
+        self.soda.related.connect(self.soda)
+
+        related = self.soda.related.symmetrical(union=True)
+        self.assertEqual(sorted(r.pk for r in related),
+                         sorted(r.pk for r in self.soda.related.symmetrical()))
+        self.assertEqual(len(related), 6)
+        self.assertEqual(len(self.soda.related.symmetrical(union=True)[:2]), 2)
+        self.assertRelatedEqual(self.beer.related.symmetrical(union=True), (
+            (self.pizza, self.beer),
+        ))
+
+        with self.assertNumQueries(2 + 3):
+            objects = self.soda.related.symmetrical_objects()
+        self.assertEqual(sorted(o.name for o in objects),
+                         ['mario', 'pizza', 'sandwich', 'table'])
+        self.assertEqual(sorted(o.name for o in self.soda.related.symmetrical_objects(Food)),
+                         ['pizza', 'sandwich'])
+        self.assertEqual(self.cereal.related.symmetrical_objects(), [])
+
+    def test_reverse_lookups(self):
+        """
+        related_to() filters on the connected object only once, and its
+        results can be paged through by keyset and resolved in bulk
+        """
+        for food in (self.pizza, self.sandwich, self.cereal):
+            food.related.connect(self.soda)
+        self.mario.related.connect(self.soda)
+        self.pizza.related.connect(self.beer)
+
+        related = self.soda.related.related_to()
+        sql = '%s' % related.query
+        self.assertEqual(sql.count('"object_type_id" ='), 1)
+        self.assertEqual(sql.count('"object_id" ='), 1)
+
+        with self.assertNumQueries(3):
+            self.assertEqual(sorted(o.name for o in self.soda.related.related_to_objects()),
+                             ['cereal', 'mario', 'pizza', 'sandwich'])
+        self.assertEqual(self.soda.related.related_to_objects(Person), [self.mario])
+
+        # page through by (-creation_date, -id), two at a time
+        expected = list(related.order_by('-creation_date', '-id'))
+        pages, cursor = [], None
+        while True:
+            with self.assertNumQueries(1):
+                page, cursor = related.paginate_after(cursor, limit=2)
+            pages.append(list(page))
+            if cursor is None:
+                break
+        self.assertEqual([len(p) for p in pages], [2, 2])
+        self.assertEqual(pages[0] + pages[1], expected)
+
+        # the generic objects of a page are resolved without refetching it
+        parents = [r.parent for r in expected[:3]]
+        page, cursor = related.paginate_after(None, limit=3)
+        with self.assertNumQueries(2):
+            self.assertEqual(page.generic_objects(), parents)
+
+        # ordering by other fields works too, ties broken by primary key
+        page, cursor = related.order_by('parent_type').paginate_after(None, limit=3)
+        self.assertEqual(len(page), 3)
+        page, cursor = related.order_by('parent_type').paginate_after(cursor, limit=3)
+        self.assertEqual(len(page), 1)
+        self.assertEqual(cursor, None)
+        self.assertRaises(ValueError, related.order_by('parent_type__model').paginate_after)
+
+    def test_keyset_pagination(self):
+        """
+        Related managers page through connections by keyset, with opaque
+        cursors that survive serialization
+        """
+        import json
+        targets = [self.soda, self.beer, self.milk, self.mario, self.sam,
+                   self.chocula, self.table]
+        for target in targets:
+            self.pizza.related.connect(target)
+        self.cereal.related.connect(self.chair)
+
+        expected = list(self.pizza.related.order_by('-creation_date', '-id'))
+        seen, cursor = [], None
+        while True:
+            page, cursor = self.pizza.related.paginate_after(cursor, limit=3)
+            seen.extend(page)
+            if cursor is None:
+                break
+            # cursors are plain strings
+            cursor = json.loads(json.dumps(cursor))
+        self.assertEqual(seen, expected)
+
+        # rows sharing a creation date are split on the primary key
+        RelatedObject.objects.update(creation_date=expected[0].creation_date)
+        expected = list(self.pizza.related.order_by('-creation_date', '-id'))
+        page, cursor = self.pizza.related.paginate_after(limit=4)
+        rest, last = self.pizza.related.paginate_after(cursor, limit=4)
+        self.assertEqual(list(page) + list(rest), expected)
+        self.assertEqual(last, None)
+
+        # the generic objects of a page can be fetched along with it
+        objects = [r.object for r in expected[:4]]
+        page, cursor = self.pizza.related.all().prefetch_generic_objects().paginate_after(limit=4)
+        with self.assertNumQueries(0):
+            self.assertEqual(page.generic_objects(), objects)
+
+        # non-generic through models are supported as well
+        self.pizza.related_beverages.connect_many([self.soda, self.beer, self.milk])
+        page, cursor = self.pizza.related_beverages.paginate_after(limit=2)
+        self.assertEqual([r.beverage for r in page], [self.milk, self.beer])
+        page, cursor = self.pizza.related_beverages.paginate_after(cursor, limit=2)
+        self.assertEqual([r.beverage for r in page], [self.soda])
+
+        self.assertRaises(ValueError, self.pizza.related.paginate_after, 'garbage')
+        # cursors only fit the ordering they were created for
+        cursor = self.pizza.related.paginate_after(limit=1)[1]
+        self.assertRaises(ValueError, self.pizza.related_beverages.paginate_after, cursor)
+
+    def test_counters(self):
+        """
+        Descriptors created with counters=True keep the number of connections
+        of each object up to date, and the counters can be recomputed
+        """
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        from genericm2m.models import RelatedObjectCount
+        soup = Recipe.objects.create(name='soup')
+        stew = Recipe.objects.create(name='stew')
+
+        soup.related.connect(self.soda)
+        soup.related.connect(self.soda)
+        soup.related.connect_many([self.beer, self.milk, self.mario])
+        stew.related.connect_many([self.beer, self.table])
+        stew.related.create(object=soup)
+
+        descriptor = Recipe.related
+        with self.assertNumQueries(1):
+            counts = descriptor.get_counts([soup, stew])
+        self.assertEqual(counts, {soup: 4, stew: 3})
+        self.assertEqual(descriptor.get_counts([soup, stew], by_type=True), {
+            soup: {Beverage: 3, Person: 1},
+            stew: {Beverage: 1, Boring: 1, Recipe: 1},
+        })
+        self.assertEqual(descriptor.get_counts(
+            [self.beer, self.soda, soup, self.chair], incoming=True),
+            {self.beer: 2, self.soda: 1, soup: 1, self.chair: 0})
+        self.assertEqual(soup.related.counter(), 4)
+        self.assertEqual(stew.related.counter(by_type=True)[Recipe], 1)
+
+        # connections removed or moved to other objects update both sides
+        soup.related.disconnect(self.beer)
+        stew.related.remove(stew.related.all().filter_generic_models(Boring).get())
+        connection = soup.related.all().filter_generic_models(Person).get()
+        stew.related.add(connection)
+        self.assertEqual(descriptor.get_counts([soup, stew], by_type=True), {
+            soup: {Beverage: 2},
+            stew: {Beverage: 1, Person: 1, Recipe: 1},
+        })
+        self.assertEqual(descriptor.get_counts([self.beer, self.mario], incoming=True),
+                         {self.beer: 1, self.mario: 1})
+
+        # counters are only updated along with the connections
+        self.assertRaises(CountedRelatedObject.DoesNotExist,
+                          soup.related.remove, connection)
+        self.assertEqual(descriptor.get_counts([soup, stew]), {soup: 2, stew: 3})
+
+        stew.related.clear()
+        self.assertEqual(descriptor.get_counts([soup, stew]), {soup: 2, stew: 0})
+        self.assertEqual(descriptor.get_counts([self.beer], incoming=True),
+                         {self.beer: 0})
+
+        # recomputing yields the same counters, minus the empty ones
+        soup.related.connect(stew)
+        expected = descriptor.get_counts([soup, stew, self.soda, self.milk], by_type=True)
+        call_command('genericm2m_counters', 'genericm2m_tests.CountedRelatedObject',
+                     batch_size=2, stdout=StringIO())
+        self.assertEqual(RelatedObjectCount.objects.filter(count=0).count(), 0)
+        self.assertEqual(descriptor.get_counts(
+            [soup, stew, self.soda, self.milk], by_type=True), expected)
+
+        self.assertRaises(ValueError, Food.related.get_counts, [self.pizza])
+        self.assertRaises(ValueError, RelatedObjectsDescriptor, RelatedBeverage,
+                          'food', 'beverage', counters=True)
+
+    def test_garbage_collection(self):
+        """
+        genericm2m_gc deletes the connections to or from objects which no
+        longer exist, in batches
+        """
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        soup = Recipe.objects.create(name='soup')
+        to_beer, to_mario, to_soda = self.pizza.related.connect_many(
+            [self.beer, self.mario, self.soda])
+        self.cereal.related.connect(self.soda)
+        to_pizza = self.milk.related.connect(self.pizza)
+        soup.related.connect_many([self.milk, self.beer])
+        gone = ContentType.objects.create(app_label='gone', model='gone')
+        RelatedObject.objects.create(
+            parent_type=gone, parent_id=1,
+            object_type=ContentType.objects.get_for_model(self.sam), object_id=self.sam.pk)
+
+        self.beer.delete()
+        self.cereal.delete()
+        expected = sorted([to_mario.pk, to_soda.pk, to_pizza.pk])
+
+        out = StringIO()
+        call_command('genericm2m_gc', dry_run=True, stdout=out)
+        self.assertIn('Found 4 orphaned connections', out.getvalue())
+        self.assertEqual(RelatedObject.objects.count(), 6)
+
+        out = StringIO()
+        call_command('genericm2m_gc', 'genericm2m.RelatedObject', batch_size=1,
+                     verbosity=2, stdout=out)
+        self.assertIn('Deleted 3 orphaned connections', out.getvalue())
+        self.assertIn('genericm2m.RelatedObject.object -> genericm2m_tests.beverage: '
+                      '2 scanned, 1 deleted', out.getvalue())
+        self.assertEqual([r.pk for r in RelatedObject.objects.order_by('pk')], expected)
+
+        # counters follow the deleted connections
+        call_command('genericm2m_gc', stdout=StringIO())
+        self.assertEqual(CountedRelatedObject.objects.count(), 1)
+        self.assertEqual(Recipe.related.get_counts([soup]), {soup: 1})
+
+    def test_cascade(self):
+        """
+        Descriptors created with cascade=True delete the connections from and
+        to objects along with them, with a single query however many objects
+        are deleted
+        """
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        soup = Recipe.objects.create(name='soup')
+        stew = Recipe.objects.create(name='stew')
+        broth = Recipe.objects.create(name='broth')
+        soup.related.connect_many([stew, self.milk, self.sam])
+        stew.related.connect_many([soup, broth, self.beer])
+        broth.related.connect(self.milk)
+        self.pizza.related.connect(soup)
+
+        soup.delete()
+        self.assertRelatedEqual(CountedRelatedObject.objects.all(), (
+            (stew, broth),
+            (stew, self.beer),
+            (broth, self.milk),
+        ))
+        self.assertEqual(Recipe.related.get_counts([stew]), {stew: 2})
+        self.assertEqual(Recipe.related.get_counts([self.milk], incoming=True),
+                         {self.milk: 1})
+        # only the descriptor's through model is cleaned up
+        self.assertEqual(self.pizza.related.count(), 1)
+
+        with CaptureQueriesContext(connection) as ctx:
+            Recipe.objects.filter(pk__in=[stew.pk, broth.pk]).delete()
+        deletes = [q['sql'] for q in ctx.captured_queries
+                   if q['sql'].startswith('DELETE') and
+                   CountedRelatedObject._meta.db_table in q['sql']]
+        self.assertEqual(len(deletes), 1)
+        self.assertEqual(CountedRelatedObject.objects.count(), 0)
+
+        self.assertRaises(ValueError, RelatedObjectsDescriptor, RelatedBeverage,
+                          'food', 'beverage', cascade=True)
+
+    def test_content_type_cache(self):
+        """
+        Once warmed up, managers filter and resolve generic objects by content
+        type id without looking up any ContentType
+        """
+        from genericm2m.models import content_types
+        self.pizza.related.connect_many([self.beer, self.mario])
+        ContentType.objects.clear_cache()
+        content_types.clear()
+
+        with self.assertNumQueries(1):
+            content_types.warm()
+        with self.assertNumQueries(3):
+            self.assertEqual(self.pizza.related.generic_objects(),
+                             [self.mario, self.beer])
+        with self.assertNumQueries(1):
+            self.assertEqual(self.pizza.related.all().filter_generic_models(Person).count(), 1)
+
+        ctype = ContentType.objects.get_for_model(Food)
+        self.assertEqual(content_types.get_id(Food), ctype.pk)
+        self.assertEqual(content_types.get_id(self.pizza), ctype.pk)
+        self.assertEqual(content_types.get_model(ctype.pk), Food)
+
+        # changes to the content types empty the cache
+        gone = ContentType.objects.create(app_label='gone', model='gone')
+        self.assertEqual(content_types.ids, {})
+        self.assertEqual(content_types.get_model(gone.pk), None)
+        with self.assertNumQueries(1):
+            self.assertEqual(content_types.get_ids([Food, Beverage]), [
+                ctype.pk, ContentType.objects.get_for_model(Beverage).pk])
+
+    def test_export(self):
+        """
+        Connections are exported as plain tuples in chunks, and as CSV or JSON
+        Lines by genericm2m_export
+        """
+        import datetime
+        import json
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        from genericm2m.models import content_types, iter_connection_values
+        connections = self.pizza.related.connect_many([self.beer, self.mario])
+        connections.append(self.soda.related.connect(self.sandwich, alias='meal'))
+        RelatedObject.objects.filter(pk=connections[0].pk).update(
+            creation_date=datetime.datetime(2000, 1, 1))
+        food, beverage, person = content_types.get_ids([Food, Beverage, Person])
+
+        with self.assertNumQueries(2):
+            rows = list(iter_connection_values(RelatedObject.objects.all(), chunk_size=2))
+        self.assertEqual([row[:5] for row in rows], [
+            (food, self.pizza.pk, beverage, self.beer.pk, ''),
+            (food, self.pizza.pk, person, self.mario.pk, ''),
+            (beverage, self.soda.pk, food, self.sandwich.pk, 'meal'),
+        ])
+        self.assertEqual(rows[0][5], datetime.datetime(2000, 1, 1))
+
+        out = StringIO()
+        call_command('genericm2m_export', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'parent_type_id,parent_id,object_type_id,'
+                                   'object_id,alias,creation_date')
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[3].startswith('%s,%s,%s,%s,meal,' % (
+            beverage, self.soda.pk, food, self.sandwich.pk)))
+
+        out = StringIO()
+        call_command('genericm2m_export', 'genericm2m.RelatedObject', format='jsonl',
+                     parent_type=['genericm2m_tests.Food'], since='2001-01-01',
+                     chunk_size=1, stdout=out)
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([(row['object_type_id'], row['object_id']) for row in rows],
+                         [(person, self.mario.pk)])
+
+    def test_instrumentation(self):
+        """
+        Receivers of the measured signal get the queries, rows, content types
+        and time of each operation of the managers they listen to
+        """
+        from genericm2m.instrumentation import assert_max_queries, measured
+        measurements = []
+
+        def receiver(sender, measurement, **kwargs):
+            measurements.append(measurement)
+
+        measured.connect(receiver, sender=Food)
+        try:
+            self.pizza.related.connect_many([self.beer, self.mario, self.soda])
+            self.pizza.related.generic_objects()
+            list(self.pizza.related.all())
+            # other models are not measured
+            self.soda.related.connect(self.milk)
+        finally:
+            measured.disconnect(receiver, sender=Food)
+        self.pizza.related.count_by_type()
+
+        self.assertEqual([
+            (m.label, m.operation, m.queries, m.rows, len(m.content_types))
+            for m in measurements
+        ], [
+            ('genericm2m_tests.Food.related', 'connect_many', 5, 3, 0),
+            ('genericm2m_tests.Food.related', 'generic_objects', 3, 6, 2),
+            ('genericm2m_tests.Food.related', 'fetch', 1, 3, 0),
+        ])
+        self.assertTrue(all(m.duration > 0 for m in measurements))
+
+        with assert_max_queries(3):
+            self.pizza.related.generic_objects()
+            # other queries are not counted
+            Food.objects.count()
+        with self.assertRaises(AssertionError):
+            with assert_max_queries(2):
+                self.pizza.related.generic_objects()
+
+    def test_generic_objects_pairs(self):
+        """
+        generic_objects() only reads ids from the rows unless asked for
+        (row, object) pairs, whose objects are then cached on the rows
+        """
+        from django.db.models.signals import post_init
+        self.pizza.related.connect_many([self.beer, self.mario, self.soda])
+        initialized = []
+
+        def receiver(sender, instance, **kwargs):
+            initialized.append(instance)
+
+        post_init.connect(receiver, sender=RelatedObject)
+        try:
+            with self.assertNumQueries(3):
+                objects = self.pizza.related.generic_objects()
+            self.assertEqual(initialized, [])
+
+            with self.assertNumQueries(3):
+                pairs = self.pizza.related.generic_objects(pairs=True)
+            self.assertEqual(len(initialized), 3)
+        finally:
+            post_init.disconnect(receiver, sender=RelatedObject)
+
+        self.assertEqual([obj for rel_obj, obj in pairs], objects)
+        with self.assertNumQueries(0):
+            self.assertEqual([rel_obj.object for rel_obj, obj in pairs], objects)
+            self.assertEqual(
+                [(rel_obj.pk, obj) for rel_obj, obj in pairs],
+                [(rel_obj.pk, rel_obj.object) for rel_obj in initialized])
+
+        self.assertEqual(
+            [obj for rel_obj, obj in self.pizza.related.generic_objects(Person, pairs=True)],
+            [self.mario])
+        self.beer.delete()
+        self.assertEqual(
+            [obj for rel_obj, obj in self.pizza.related.generic_objects(
+                missing='none', pairs=True)],
+            [self.soda, self.mario, None])
+
+    def test_generic_objects_querysets(self):
+        """
+        The queries fetching the generic objects of each model can be
+        customized, e.g. to load some of their fields only
+        """
+        self.pizza.related.connect_many([self.beer, self.mario, self.soda])
+
+        with self.assertNumQueries(4):
+            objects = self.pizza.related.generic_objects(querysets={
+                Beverage: {'only': ['id']},
+                Person: {'defer': ['name'], 'prefetch_related': ['related']},
+            })
+        self.assertEqual(objects, [self.soda, self.mario, self.beer])
+        self.assertEqual([obj.get_deferred_fields() for obj in objects],
+                         [set(['name'])] * 3)
+        with self.assertNumQueries(0):
+            self.assertEqual(list(objects[1].related.all()), [])
+
+        def querysets(model):
+            if model is Beverage:
+                return Beverage.objects.exclude(name='soda')
+
+        self.assertEqual(
+            self.pizza.related.generic_objects(missing='skip', querysets=querysets),
+            [self.mario, self.beer])
+        self.assertEqual(
+            self.beer.related.related_to_objects(querysets={Food: {'only': ['id']}})[0]
+            .get_deferred_fields(), set(['name']))
+
+        self.assertRaises(ValueError, self.pizza.related.generic_objects,
+                          querysets={Beverage: {'order_by': ['name']}})
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'requires Python 3.5+')
+class AsyncRelationsTestCase(TransactionTestCase):
+    """
+    The queries run in a worker thread, whose connection cannot see the data
+    of a transaction left open by TestCase
+    """
+    def run_async(self, coroutine):
+        import asyncio
+        return asyncio.get_event_loop().run_until_complete(coroutine)
+
+    def test_async_methods(self):
+        pizza = Food.objects.create(name='pizza')
+        sandwich = Food.objects.create(name='sandwich')
+        soda = Beverage.objects.create(name='soda')
+        beer = Beverage.objects.create(name='beer')
+        mario = Person.objects.create(name='mario')
+
+        soda_rel = self.run_async(pizza.related.aconnect(soda))
+        self.assertEqual(soda_rel.object, soda)
+        self.run_async(pizza.related.aadd(RelatedObject(object=mario),
+                                          RelatedObject(object=beer)))
+        self.run_async(sandwich.related.aconnect(pizza))
+
+        self.assertEqual(self.run_async(pizza.related.ageneric_objects()),
+                         [beer, mario, soda])
+        self.assertEqual(self.run_async(pizza.related.ageneric_objects(Beverage)),
+                         [beer, soda])
+        self.assertEqual(self.run_async(pizza.related.ageneric_objects(parallel=False)),
+                         [beer, mario, soda])
+        self.assertEqual(
+            [rel_obj.parent for rel_obj in self.run_async(soda.related.arelated_to())],
+            [pizza])
+        self.assertEqual(
+            len(self.run_async(pizza.related.asymmetrical(union=True))), 4)
+
+        beer.delete()
+        self.assertEqual(
+            self.run_async(pizza.related.ageneric_objects(missing='none')),
+            [None, mario, soda])
+        self.assertRaises(Beverage.DoesNotExist, self.run_async,
+                          pizza.related.ageneric_objects())
+
+        self.run_async(pizza.related.aremove(soda_rel))
+        self.assertEqual(pizza.related.generic_objects(missing='skip'), [mario])
+        self.run_async(pizza.related.aclear())
+        self.assertEqual(pizza.related.count(), 0)
@@ -0,0 +1,148 @@
+"""
+Opt-in measurements of the work done by the related managers.  Connect a
+receiver to ``measured`` and every operation of a RelatedObjectsDescriptor --
+manager methods, evaluating the querysets they return, traversals -- sends it
+a Measurement once done::
+
+    from genericm2m.instrumentation import measured
+
+    def report(sender, measurement, **kwargs):
+        statsd.timing('genericm2m.%s.%s' % (measurement.label, measurement.operation),
+                      measurement.duration)
+
+    measured.connect(report)
+
+While nobody listens, nothing is measured.
+"""
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from threading import local
+from timeit import default_timer
+
+from django.db import connections, router
+from django.dispatch import Signal
+
+
+measured = Signal(providing_args=['measurement'])
+
+state = local()
+
+
+class Measurement(object):
+    """
+    Queries run, rows fetched, content types touched and time spent by one
+    operation of a descriptor, including the operations it relies on
+    """
+    def __init__(self, descriptor, operation):
+        self.descriptor = descriptor
+        self.operation = operation
+        self.queries = 0
+        self.rows = 0
+        self.content_types = set()
+        self.duration = 0
+
+    @property
+    def label(self):
+        opts = self.descriptor.model_class._meta
+        return '%s.%s.%s' % (opts.app_label, opts.object_name, self.descriptor.name)
+
+    def __repr__(self):
+        return '<Measurement %s.%s: %s queries, %s rows, %s content types, %.2fms>' % (
+            self.label, self.operation, self.queries, self.rows,
+            len(self.content_types), self.duration * 1000)
+
+
+def is_measuring(descriptor):
+    """
+    Whether an operation of ``descriptor`` starting now should be measured:
+    somebody listens and no operation, which would include it, is already
+    being measured
+    """
+    return getattr(state, 'measurement', None) is None and \
+        measured.has_listeners(descriptor.model_class)
+
+
+@contextmanager
+def measure(descriptor, operation, using):
+    """
+    Measures the block as ``operation`` of ``descriptor``, if is_measuring()
+    """
+    if not is_measuring(descriptor):
+        yield
+        return
+
+    # the queries are logged apart, then added back to the regular log
+    connection = connections[using]
+    force_debug_cursor = connection.force_debug_cursor
+    queries_log = connection.queries_log
+    connection.force_debug_cursor = True
+    connection.queries_log = deque(maxlen=queries_log.maxlen)
+
+    measurement = state.measurement = Measurement(descriptor, operation)
+    start = default_timer()
+    try:
+        yield
+    finally:
+        measurement.duration = default_timer() - start
+        measurement.queries = len(connection.queries_log)
+        queries_log.extend(connection.queries_log)
+        connection.queries_log = queries_log
+        connection.force_debug_cursor = force_debug_cursor
+        state.measurement = None
+
+    measured.send(sender=descriptor.model_class, measurement=measurement)
+
+
+def record(rows=0, content_types=()):
+    """
+    Add to the measurement of the operation in progress, if any
+    """
+    measurement = getattr(state, 'measurement', None)
+    if measurement is not None:
+        measurement.rows += rows
+        measurement.content_types.update(content_types)
+
+
+def instrumented(method):
+    """
+    Measures each call to a method of a related manager or descriptor
+    """
+    @wraps(method)
+    def inner(self, *args, **kwargs):
+        descriptor = getattr(self, 'descriptor', self)
+        if not is_measuring(descriptor):
+            return method(self, *args, **kwargs)
+
+        using = getattr(self, 'db', None) or router.db_for_read(descriptor.related_model)
+        with measure(descriptor, method.__name__, using):
+            return method(self, *args, **kwargs)
+    return inner
+
+
+class assert_max_queries(object):
+    """
+    Context manager for tests, failing if the related managers run more than
+    ``max_queries`` queries inside it.  Other queries are not counted.
+    """
+    def __init__(self, max_queries):
+        self.max_queries = max_queries
+        self.measurements = []
+
+    def __enter__(self):
+        measured.connect(self.receive, weak=False, dispatch_uid=id(self))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        measured.disconnect(dispatch_uid=id(self))
+        if exc_type is not None:
+            return
+
+        queries = sum(measurement.queries for measurement in self.measurements)
+        if queries > self.max_queries:
+            raise AssertionError('%s generic-m2m queries executed, at most %s expected:\n%s' % (
+                queries, self.max_queries,
+                '\n'.join(repr(measurement) for measurement in self.measurements)))
+
+    def receive(self, sender, measurement, **kwargs):
+        self.measurements.append(measurement)
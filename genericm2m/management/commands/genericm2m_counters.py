@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from genericm2m.models import RelatedObjectCount
+from genericm2m.utils import get_descriptors
+
+
+class Command(BaseCommand):
+    help = ('Recomputes from scratch the connection counters of the through '
+            'models used by descriptors created with counters=True')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'models', nargs='*', metavar='app_label.ModelName',
+            help='Only recompute the counters of these through models')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of counters inserted per query')
+
+    def handle(self, *args, **options):
+        try:
+            descriptors = get_descriptors(options['models'])
+        except LookupError as exc:
+            raise CommandError(exc)
+
+        for model, descriptor in descriptors.items():
+            if not descriptor.counters:
+                if options['models']:
+                    raise CommandError('No descriptor keeps counters for %s.%s' % (
+                        model._meta.app_label, model._meta.object_name))
+                continue
+
+            written = RelatedObjectCount.objects.recompute(
+                descriptor, options['batch_size'])
+            self.stdout.write('Wrote %s counters for %s.%s' % (
+                written, model._meta.app_label, model._meta.object_name))
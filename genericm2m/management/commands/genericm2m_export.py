@@ -0,0 +1,88 @@
+import csv
+import json
+from itertools import islice
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.dateparse import parse_date, parse_datetime
+
+from genericm2m.models import content_types, get_export_fields, iter_connection_values
+
+
+class Command(BaseCommand):
+    help = ('Exports the connections stored in a through model as CSV or JSON '
+            'Lines, streaming them in chunks')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'model', nargs='?', default='genericm2m.RelatedObject',
+            metavar='app_label.ModelName',
+            help='Through model to export, genericm2m.RelatedObject by default')
+        parser.add_argument(
+            '--format', choices=['csv', 'jsonl'], default='csv',
+            help='Output format')
+        parser.add_argument(
+            '--output', '-o',
+            help='File to write to instead of the standard output')
+        parser.add_argument(
+            '--chunk-size', type=int, default=2000,
+            help='Number of connections read and written at a time')
+        parser.add_argument(
+            '--parent-type', action='append', default=[], metavar='app_label.ModelName',
+            help='Only export connections from objects of this model')
+        parser.add_argument(
+            '--object-type', action='append', default=[], metavar='app_label.ModelName',
+            help='Only export connections to objects of this model')
+        parser.add_argument(
+            '--since', help='Only export connections created at or after this date')
+        parser.add_argument(
+            '--until', help='Only export connections created before this date')
+        parser.add_argument(
+            '--date-field', default='creation_date',
+            help='Field the --since and --until dates apply to')
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+            query = {}
+            for side in ('parent', 'object'):
+                if options['%s_type' % side]:
+                    query['%s_type_id__in' % side] = content_types.get_ids(
+                        [apps.get_model(label) for label in options['%s_type' % side]])
+        except (LookupError, ValueError) as exc:
+            raise CommandError(exc)
+
+        for option, lookup in (('since', 'gte'), ('until', 'lt')):
+            if options[option]:
+                value = parse_datetime(options[option]) or parse_date(options[option])
+                if value is None:
+                    raise CommandError('Invalid date: %s' % options[option])
+                query['%s__%s' % (options['date_field'], lookup)] = value
+
+        fields = get_export_fields(model)
+        rows = iter_connection_values(
+            model._base_manager.filter(**query), fields, options['chunk_size'])
+
+        stream = open(options['output'], 'w') if options['output'] else self.stdout
+        try:
+            self.export(rows, fields, stream, options['format'], options['chunk_size'])
+        finally:
+            if options['output']:
+                stream.close()
+
+    def export(self, rows, fields, stream, format, chunk_size):
+        if format == 'csv':
+            writer = csv.writer(stream, lineterminator='\n')
+            writer.writerow(fields)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+
+            if format == 'csv':
+                writer.writerows(chunk)
+            else:
+                stream.write(''.join(
+                    json.dumps(dict(zip(fields, row)), cls=DjangoJSONEncoder) + '\n'
+                    for row in chunk))
@@ -0,0 +1,68 @@
+import time
+from collections import OrderedDict
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+
+from genericm2m.utils import get_descriptors
+
+
+class Command(BaseCommand):
+    help = ('Deletes the connections whose generic objects no longer exist, '
+            'in small batches so the tables are never locked for long')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'models', nargs='*', metavar='app_label.ModelName',
+            help='Only collect the orphaned rows of these through models')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of rows checked and deleted at a time')
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help='Seconds to wait between two batches')
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help='Only report the orphaned rows, without deleting them')
+
+    def handle(self, *args, **options):
+        try:
+            descriptors = get_descriptors(options['models'])
+        except LookupError as exc:
+            raise CommandError(exc)
+
+        verbosity = options['verbosity']
+        total = 0
+        for model, descriptor in descriptors.items():
+            progress = OrderedDict()
+            for field, ctype_id, scanned, orphans in descriptor.iter_orphans(
+                    options['batch_size']):
+                if orphans and not options['dry_run']:
+                    descriptor.delete_connections(orphans)
+
+                key = (field.name, ctype_id)
+                counts = progress.setdefault(key, [0, 0])
+                counts[0] += scanned
+                counts[1] += len(orphans)
+                total += len(orphans)
+                if verbosity > 1:
+                    self.report(model, key, counts, options['dry_run'])
+
+                if options['sleep']:
+                    time.sleep(options['sleep'])
+
+            if verbosity == 1:
+                for key, counts in progress.items():
+                    if counts[1]:
+                        self.report(model, key, counts, options['dry_run'])
+
+        self.stdout.write('%s %s orphaned connections' % (
+            'Found' if options['dry_run'] else 'Deleted', total))
+
+    def report(self, model, key, counts, dry_run):
+        field_name, ctype_id = key
+        ctype = ContentType.objects.get_for_id(ctype_id)
+        self.stdout.write('%s.%s.%s -> %s.%s: %s scanned, %s %s' % (
+            model._meta.app_label, model._meta.object_name, field_name,
+            ctype.app_label, ctype.model, counts[0], counts[1],
+            'orphaned' if dry_run else 'deleted'))
@@ -1,21 +1,153 @@
 # -*- coding: utf-8 -*-
 import django
+try:
+    from django.apps import apps
+    get_models = apps.get_models
+except ImportError:
+    from django.db.models import get_models
 try:
     from django.contrib.contenttypes.fields import GenericForeignKey
 except ImportError:
     from django.contrib.contenttypes.generic import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
-from django.db.models import Q
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import Count, F, Q
+from django.db.models import signals
 from django.db.models.query import QuerySet
 
+import base64
+import json
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import islice
+from operator import attrgetter
 from sys import version_info
+from threading import local
 from genericm2m import PY3, unicode, str
+from genericm2m.instrumentation import instrumented, is_measuring, measure, record
+
+if version_info >= (3, 5):
+    from genericm2m.aio import AsyncRelatedManagerMixin
+else:
+    class AsyncRelatedManagerMixin(object):
+        pass
+
+
+def get_concrete_models(model):
+    """
+    ``model``, or a list of models, as a tuple in which proxies are replaced
+    by their concrete model, whose content type they share
+    """
+    if not isinstance(model, (list, tuple)):
+        model = (model,)
+    return tuple(m._meta.concrete_model if getattr(getattr(m, '_meta', None), 'proxy', False)
+                 else m for m in model)
+
+
+class ContentTypeCache(object):
+    """
+    Two-way map between models and the ids of their content types, so that
+    filtering connections and resolving generic objects never builds or looks
+    up ContentType objects.  It is filled with a single query by warm() and
+    otherwise lazily, and emptied whenever content types change.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.models = {}
+        self.subclass_ids = {}
+        self.natural_keys = {}
+
+    def prepare(self):
+        """
+        Called once the apps are ready, maps the natural key of each model's
+        content type to the model so warm() does not need to
+        """
+        self.natural_keys = dict(
+            ((model._meta.app_label, model._meta.model_name), model)
+            for model in get_models())
+        self.subclass_ids = {}
+
+    def warm(self, using=None):
+        """
+        Load the ids of all the content types at once, e.g. from a deployment
+        hook or wsgi.py, so no request pays for the first lookups
+        """
+        if not self.natural_keys:
+            self.prepare()
+
+        ids, models = {}, {}
+        ctypes = ContentType.objects.db_manager(using).values_list(
+            'pk', 'app_label', 'model')
+        for ctype_id, app_label, model_name in ctypes:
+            model = self.natural_keys.get((app_label, model_name))
+            models[ctype_id] = model
+            if model is not None:
+                ids[model] = ctype_id
+        self.ids, self.models, self.subclass_ids = ids, models, {}
+
+    def clear(self, **kwargs):
+        self.ids, self.models, self.subclass_ids = {}, {}, {}
+
+    def get_id(self, model):
+        """
+        Id of the content type of ``model``, a model class or instance
+        """
+        model = model._meta.concrete_model
+        try:
+            return self.ids[model]
+        except KeyError:
+            return self.get_ids([model])[0]
+
+    def get_ids(self, models):
+        """
+        Ids of the content types of ``models``, looking up the missing ones
+        with a single query
+        """
+        models = [model._meta.concrete_model for model in models]
+        missing = [model for model in models if model not in self.ids]
+        if missing:
+            for model, ctype in ContentType.objects.get_for_models(*missing).items():
+                self.ids[model] = ctype.pk
+                self.models.setdefault(ctype.pk, model)
+        return [self.ids[model] for model in models]
+
+    def get_subclass_ids(self, models):
+        """
+        Ids of the content types of the concrete models subclassing one of the
+        tuple ``models``, computed once per tuple
+        """
+        try:
+            return self.subclass_ids[models]
+        except KeyError:
+            matching = [m for m in get_models()
+                        if not m._meta.proxy and issubclass(m, models)]
+            ctype_ids = self.subclass_ids[models] = frozenset(self.get_ids(matching))
+            return ctype_ids
+
+    def get_model(self, ctype_id):
+        """
+        Model class of the content type ``ctype_id``, or None if the model no
+        longer exists
+        """
+        try:
+            return self.models[ctype_id]
+        except KeyError:
+            model = ContentType.objects.get_for_id(ctype_id).model_class()
+            self.models[ctype_id] = model
+            return model
+
+content_types = ContentTypeCache()
+
 
 class GFKOptimizedQuerySet(QuerySet):
     def __init__(self, *args, **kwargs):
         # pop the gfk_field from the kwargs if its passed in explicitly
         self._gfk_field = kwargs.pop('gfk_field', None)
+        self._descriptor = kwargs.pop('descriptor', None)
+        self._prefetch_gfk = False
 
         # call the parent class' initializer
         super(GFKOptimizedQuerySet, self).__init__(*args, **kwargs)
@@ -23,8 +155,52 @@ class GFKOptimizedQuerySet(QuerySet):
     def _clone(self, *args, **kwargs):
         clone = super(GFKOptimizedQuerySet, self)._clone(*args, **kwargs)
         clone._gfk_field = self._gfk_field
+        clone._descriptor = self._descriptor
+        clone._prefetch_gfk = self._prefetch_gfk
+        return clone
+
+    def _fetch_all(self):
+        if self._result_cache is not None or self._descriptor is None:
+            return self.fetch_all()
+
+        if not is_measuring(self._descriptor):
+            # the rows still count towards the operation including this one
+            self.fetch_all()
+            record(rows=len(self._result_cache))
+            return
+
+        with measure(self._descriptor, 'fetch', self.db):
+            self.fetch_all()
+            record(rows=len(self._result_cache))
+
+    def fetch_all(self):
+        attach = self._result_cache is None and self._prefetch_gfk
+        super(GFKOptimizedQuerySet, self)._fetch_all()
+        if attach:
+            self.attach_generic_objects(
+                [obj for obj in self._result_cache if isinstance(obj, self.model)])
+
+    def prefetch_generic_objects(self):
+        """
+        When the queryset is evaluated, fetch the generic objects of all the
+        rows with one query per content type and cache them on each row
+        """
+        clone = self._clone()
+        clone._prefetch_gfk = True
         return clone
 
+    def attach_generic_objects(self, rel_objs):
+        gfk_field = self.get_gfk()
+        ctype_field = '%s_id' % gfk_field.ct_field
+        fk_field = gfk_field.fk_field
+
+        gfk_objects = self.get_generic_objects_by_type(
+            (getattr(rel_obj, ctype_field), getattr(rel_obj, fk_field))
+            for rel_obj in rel_objs)
+        for rel_obj in rel_objs:
+            setattr(rel_obj, gfk_field.cache_attr,
+                    gfk_objects[getattr(rel_obj, ctype_field)].get(getattr(rel_obj, fk_field)))
+
     def get_gfk(self):
         if not self._gfk_field:
             for field in self.model._meta.virtual_fields:
@@ -34,40 +210,442 @@ class GFKOptimizedQuerySet(QuerySet):
 
         return self._gfk_field
 
-    def generic_objects(self, model=None):
-        clone = self._clone()
+    def get_content_type_ids(self, model):
+        """
+        Ids of the content types whose objects are instances of ``model`` (or
+        of one of a list of models), subclasses included.  Proxies match the
+        objects of their concrete model.
+        """
+        return content_types.get_subclass_ids(get_concrete_models(model))
+
+    def filter_generic_models(self, model):
+        """
+        Restrict the queryset to rows whose generic object is an instance of
+        ``model`` (or of one of a list of models), subclasses included
+        """
+        gfk_field = self.get_gfk()
+        return self.filter(**{
+            '%s_id__in' % gfk_field.ct_field: self.get_content_type_ids(model)
+        })
+
+    def get_target_queryset(self, model_class, querysets=None):
+        """
+        The queryset the generic objects of ``model_class`` are fetched from.
+        ``querysets`` is either a callable taking the model and returning a
+        queryset, or a dictionary mapping models to a queryset or to the
+        arguments of its ``only``, ``defer``, ``select_related`` and
+        ``prefetch_related`` methods, e.g. {Article: {'only': ['title']}}.
+        The model's default manager is used otherwise.
+        """
+        if callable(querysets):
+            queryset = querysets(model_class)
+        else:
+            queryset = (querysets or {}).get(model_class)
+
+        if isinstance(queryset, dict):
+            spec = queryset
+            invalid = set(spec) - set(['only', 'defer', 'select_related',
+                                      'prefetch_related'])
+            if invalid:
+                raise ValueError(u'Invalid queryset options for %s: %s' % (
+                    model_class._meta.object_name, ', '.join(sorted(invalid))))
+
+            queryset = model_class._default_manager.all()
+            for method in ('only', 'defer', 'select_related', 'prefetch_related'):
+                if method in spec:
+                    queryset = getattr(queryset, method)(*spec[method])
+
+        if queryset is None:
+            queryset = model_class._default_manager.all()
+        return queryset
 
+    def get_generic_objects_by_type(self, keys, querysets=None):
+        """
+        Given an iterable of (content type id, object id) pairs, returns a
+        dictionary mapping content type id -> {object id: object}, issuing a
+        single query per content type.  See ``get_target_queryset`` for
+        ``querysets``.
+        """
         ctypes_and_fks = {}
+        for ctype_id, obj_id in keys:
+            ctypes_and_fks.setdefault(ctype_id, [])
+            ctypes_and_fks[ctype_id].append(obj_id)
+
+        return dict(
+            (ctype_id, self.get_generic_objects_for_type(ctype_id, obj_ids, querysets))
+            for ctype_id, obj_ids in ctypes_and_fks.items())
+
+    def get_generic_objects_for_type(self, ctype_id, obj_ids, querysets=None):
+        """
+        Returns a dictionary mapping object id -> object for the objects of
+        content type ``ctype_id``, fetched with a single query
+        """
+        model_class = content_types.get_model(ctype_id)
+        if model_class is None:
+            # the model has been removed, none of its objects exist
+            return {}
+
+        objs = self.get_target_queryset(model_class, querysets).in_bulk(obj_ids)
+        if objs:
+            # when the object id column is of a different type than the
+            # primary key (e.g. a CharField holding integers), re-key the
+            # objects by the column type once instead of converting each
+            # row's id
+            fk_field = self.model._meta.get_field(self.get_gfk().fk_field)
+            pk = next(iter(objs))
+            if fk_field.to_python(pk) != pk:
+                objs = dict((fk_field.to_python(pk), obj) for pk, obj in objs.items())
+
+        record(rows=len(objs), content_types=[ctype_id])
+        return objs
+
+    def handle_missing_object(self, pk, ctype_id, obj_id, model, missing, orphans):
+        """
+        Called when the generic object of the relationship row ``pk`` does not
+        exist.  Records the row in ``orphans`` and applies the ``missing``
+        policy, returning True if None should stand in for the object
+        """
+        model_class = None
+        if ctype_id is not None:
+            model_class = content_types.get_model(ctype_id)
+        if model and not (model_class and issubclass(model_class, model)):
+            return False
+
+        if orphans is not None:
+            orphans.append(pk)
+
+        if missing == 'raise':
+            exc_class = getattr(model_class, 'DoesNotExist', ObjectDoesNotExist)
+            raise exc_class(u'Object %r of content type %r, referenced by %s %r, '
+                            u'does not exist.' % (obj_id, ctype_id,
+                                                  self.model._meta.object_name, pk))
+        return missing == 'none'
+
+    def check_missing_policy(self, missing):
+        if missing not in ('raise', 'skip', 'none'):
+            raise ValueError(u"missing must be one of 'raise', 'skip' or 'none'")
+
+    def generic_objects(self, model=None, missing='raise', orphans=None,
+                        pairs=False, querysets=None):
+        """
+        Returns the generic objects referenced by the rows of the queryset,
+        fetching them with one query per content type.
+
+        ``missing`` controls what happens when a row points at an object that
+        no longer exists: 'raise' an ObjectDoesNotExist, 'skip' the row or
+        return None in its place.  If a list is passed as ``orphans``, the
+        primary keys of such rows are appended to it.
+
+        Unless the queryset has already been evaluated, only the ids are read
+        from the rows, without building model instances.  With ``pairs``, a
+        list of (row, object) tuples is returned instead, and each object is
+        cached on its row.
+
+        ``querysets`` customizes the queries fetching the objects of each
+        model, e.g. to load only some of their fields, see
+        ``get_target_queryset``.
+        """
+        self.check_missing_policy(missing)
+        if model:
+            model = get_concrete_models(model)
+
+        # reuse the rows if this queryset has already been evaluated, which is
+        # the case when it was populated by prefetch_related()
+        if self._result_cache is not None:
+            clone = self
+        elif model and self.query.can_filter():
+            clone = self.filter_generic_models(model)
+        else:
+            clone = self._clone()
 
         gfk_field = self.get_gfk()
         ctype_field = '%s_id' % gfk_field.ct_field
-        fk_field = gfk_field.fk_field
-
-        for obj in clone:
-            ctype = ContentType.objects.get_for_id(getattr(obj, ctype_field))
-            obj_id = getattr(obj, fk_field)
+        if clone._result_cache is None and not pairs:
+            rows = clone.values_list('pk', ctype_field, gfk_field.fk_field)
+            return list(self.resolve_generic_objects(
+                rows, model, missing, orphans, querysets))
 
-            ctypes_and_fks.setdefault(ctype, [])
-            ctypes_and_fks[ctype].append(obj_id)
+        get_key = attrgetter(ctype_field, gfk_field.fk_field)
+        cache_attr = gfk_field.cache_attr
+        rel_objs = list(clone)
 
-        gfk_objects = {}
-        for ctype, obj_ids in ctypes_and_fks.items():
-            gfk_objects[ctype.pk] = ctype.model_class()._default_manager.in_bulk(obj_ids)
+        # skip any generic objects that have already been fetched
+        gfk_objects = self.get_generic_objects_by_type(
+            (get_key(rel_obj) for rel_obj in rel_objs
+             if not hasattr(rel_obj, cache_attr)), querysets)
 
         obj_list = []
-        for obj in clone:
-            obj = gfk_objects[getattr(obj, ctype_field)][getattr(obj, fk_field)]
-            if not model or (model and isinstance(obj, model)):
-                obj_list.append(obj)
+        for rel_obj in rel_objs:
+            ctype_id, obj_id = get_key(rel_obj)
+            if hasattr(rel_obj, cache_attr):
+                obj = getattr(rel_obj, cache_attr)
+            else:
+                obj = gfk_objects[ctype_id].get(obj_id)
+                if pairs and obj is not None:
+                    setattr(rel_obj, cache_attr, obj)
+
+            if obj is None:
+                if not self.handle_missing_object(rel_obj.pk, ctype_id, obj_id,
+                                                  model, missing, orphans):
+                    continue
+            elif model and not isinstance(obj, model):
+                continue
+            obj_list.append((rel_obj, obj) if pairs else obj)
 
         return obj_list
 
+    def iter_generic_objects(self, model=None, chunk_size=1000, missing='raise',
+                             orphans=None, querysets=None):
+        """
+        Like generic_objects(), but yields the objects while walking the
+        relationship rows in chunks of ``chunk_size``, so only one chunk of
+        objects is held in memory at a time
+        """
+        self.check_missing_policy(missing)
+        if model:
+            model = get_concrete_models(model)
+
+        gfk_field = self.get_gfk()
+        ctype_field = '%s_id' % gfk_field.ct_field
+        fk_field = gfk_field.fk_field
+
+        queryset = self
+        if model and self.query.can_filter():
+            queryset = self.filter_generic_models(model)
+        rows = queryset.values_list('pk', ctype_field, fk_field).iterator()
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+
+            for obj in self.resolve_generic_objects(chunk, model, missing,
+                                                    orphans, querysets):
+                yield obj
+
+    def resolve_generic_objects(self, rows, model=None, missing='raise',
+                                orphans=None, querysets=None):
+        """
+        Yields the generic objects for a list of (row pk, content type id,
+        object id) tuples, in order, with one query per content type.  The
+        arguments are the same as for generic_objects().
+        """
+        if model:
+            model = get_concrete_models(model)
+        rows = self.filter_generic_rows(rows, model)
+        gfk_objects = self.get_generic_objects_by_type(
+            ((ctype_id, obj_id) for pk, ctype_id, obj_id in rows), querysets)
+        return self.match_generic_objects(rows, gfk_objects, model, missing, orphans)
+
+    def filter_generic_rows(self, rows, model=None):
+        """
+        The (row pk, content type id, object id) tuples in ``rows`` whose
+        content type is ``model`` or a subclass, as a list
+        """
+        if not model:
+            return list(rows)
+        ctype_ids = self.get_content_type_ids(model)
+        return [row for row in rows if row[1] in ctype_ids]
+
+    def match_generic_objects(self, rows, gfk_objects, model=None,
+                              missing='raise', orphans=None):
+        """
+        Yields the object in ``gfk_objects``, as returned by
+        get_generic_objects_by_type(), for each row of ``rows``
+        """
+        for pk, ctype_id, obj_id in rows:
+            obj = gfk_objects[ctype_id].get(obj_id)
+            if obj is None:
+                if self.handle_missing_object(pk, ctype_id, obj_id, model,
+                                              missing, orphans):
+                    yield None
+            elif not model or isinstance(obj, model):
+                yield obj
+
+    def paginate_after(self, cursor=None, limit=20):
+        """
+        Keyset pagination, see ``genericm2m.models.paginate_after``.  The
+        page is a GFKOptimizedQuerySet, so its generic objects can be fetched
+        without querying the rows again.
+        """
+        return paginate_after(self, cursor, limit)
+
+
+def paginate_after(queryset, cursor=None, limit=20):
+    """
+    Keyset pagination: returns the ``limit`` rows of ``queryset`` following
+    ``cursor`` along with the cursor of the next page, or None on the last
+    page.  Cursors are opaque strings which can be handed to clients and
+    passed back in; unlike with OFFSET, every page costs the same.
+    """
+    ordering = get_keyset_ordering(queryset)
+    queryset = queryset.order_by(*ordering)
+    if cursor is not None:
+        values = decode_cursor(queryset.model, ordering, cursor)
+        queryset = queryset.filter(keyset_filter(ordering, values))
+
+    page = queryset[:limit + 1]
+    rows = list(page)
+    next_cursor = None
+    if len(rows) > limit:
+        page._result_cache = rows = rows[:limit]
+        next_cursor = encode_cursor(ordering, rows[-1])
+    return page, next_cursor
+
+
+def get_keyset_ordering(queryset):
+    """
+    The fields ``queryset`` is ordered by, with the primary key appended to
+    break ties, suitable for keyset pagination
+    """
+    opts = queryset.model._meta
+    if queryset.query.order_by:
+        ordering = list(queryset.query.order_by)
+    elif queryset.query.default_ordering:
+        ordering = list(opts.ordering)
+    else:
+        ordering = []
+
+    keyset = []
+    for field in ordering:
+        if not isinstance(field, (unicode, type(''))) or field == '?' or \
+                '__' in field:
+            raise ValueError(u'Keyset pagination requires ordering by fields '
+                             u'of %s, got %r' % (opts.object_name, field))
+        if field.lstrip('-') == 'pk':
+            field = field.replace('pk', opts.pk.name)
+        keyset.append(field)
+
+    if opts.pk.name not in [field.lstrip('-') for field in keyset]:
+        descending = bool(keyset) and keyset[-1].startswith('-')
+        keyset.append('-%s' % opts.pk.name if descending else opts.pk.name)
+    return keyset
+
+
+def encode_cursor(ordering, obj):
+    """
+    Serialize the values ``obj`` has for the ``ordering`` fields into an
+    opaque, url-safe cursor
+    """
+    values = []
+    for field in ordering:
+        value = getattr(obj, obj._meta.get_field(field.lstrip('-')).attname)
+        if hasattr(value, 'isoformat'):
+            # keep the microseconds, which DjangoJSONEncoder drops
+            value = value.isoformat()
+        elif not isinstance(value, (int, float, bool, unicode, type(''))) and \
+                value is not None:
+            value = u'%s' % value
+        values.append(value)
+    data = json.dumps({'o': ordering, 'v': values}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(model, ordering, cursor):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(
+            cursor.encode('ascii')).decode('utf-8'))
+        values = data['v']
+        if data['o'] != ordering or len(values) != len(ordering):
+            raise ValueError
+        return [
+            model._meta.get_field(field.lstrip('-')).to_python(value)
+            for field, value in zip(ordering, values)
+        ]
+    except (AttributeError, KeyError, TypeError, ValueError, ValidationError):
+        raise ValueError(u'Invalid cursor %r' % (cursor,))
+
+
+def keyset_filter(ordering, values):
+    """
+    Filter matching the rows that come after ``values`` when ordering by
+    ``ordering``, i.e. (a, b) > (x, y) spelled out as a > x OR (a = x AND b > y)
+    """
+    query = Q()
+    for i, field in enumerate(ordering):
+        name = field.lstrip('-')
+        lookup = '%s__%s' % (name, 'lt' if field.startswith('-') else 'gt')
+        clause = Q(**{lookup: values[i]})
+        for prev_field, value in zip(ordering[:i], values):
+            clause &= Q(**{prev_field.lstrip('-'): value})
+        query |= clause
+    return query
+
+
+def iter_connection_values(queryset, fields=None, chunk_size=2000):
+    """
+    Streams the rows of ``queryset``, of a through model, as tuples of the
+    values of ``fields`` -- by default every column but the primary key, i.e.
+    (parent_type_id, parent_id, object_type_id, object_id, alias,
+    creation_date) for RelatedObject.  The rows are read in primary key order
+    with one query per ``chunk_size`` rows, so no model instances are built
+    and no cursor is held open between chunks.
+    """
+    if fields is None:
+        fields = get_export_fields(queryset.model)
+    queryset = queryset.order_by('pk').values_list('pk', *fields)
+
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1][0]
+
+        for row in chunk:
+            yield row[1:]
+        if len(chunk) < chunk_size:
+            break
+
+
+def get_export_fields(model):
+    return [field.attname for field in model._meta.concrete_fields
+            if not field.primary_key]
+
+
+class RelatedManagerCache(dict):
+    """
+    Per-instance memo of the related managers handed out by each descriptor.
+    Managers are built from classes generated at runtime and cannot be
+    pickled, so the memo is always restored empty.
+    """
+    def __reduce__(self):
+        return (self.__class__, ())
+
 
 class RelatedObjectsDescriptor(object):
-    def __init__(self, model=None, from_field='parent', to_field='object'):
+    def __init__(self, model=None, from_field='parent', to_field='object',
+                 cache=None, cache_timeout=DEFAULT_TIMEOUT, counters=False,
+                 cascade=False):
         self.related_model = model or RelatedObject
         self.from_field = self.get_related_model_field(from_field)
         self.to_field = self.get_related_model_field(to_field)
+        self.manager_classes = {}
+
+        # name of the django cache used to store the connections of each
+        # instance, True meaning the default cache
+        self.cache_alias = 'default' if cache is True else cache
+        self.cache_timeout = cache_timeout
+        if self.cache_alias and not self.is_gfk(self.to_field):
+            raise ValueError(u'Caching connections requires a GenericForeignKey '
+                             u'as to_field')
+
+        # whether the number of connections of each object is stored in
+        # RelatedObjectCount and kept up to date by the managers
+        self.counters = counters
+        if self.counters and not (self.is_gfk(self.from_field) and
+                                  self.is_gfk(self.to_field)):
+            raise ValueError(u'Counters require GenericForeignKeys as from_field '
+                             u'and to_field')
+
+        # whether the connections from and to an instance are deleted along
+        # with it, which the database does for regular foreign keys only
+        self.cascade = cascade
+        self.deleting = local()
+        if self.cascade and not (self.is_gfk(self.from_field) or
+                                 self.is_gfk(self.to_field)):
+            raise ValueError(u'Deleting connections along with objects requires a '
+                             u'GenericForeignKey as from_field or to_field')
 
     def get_related_model_field(self, field_name):
         opts = self.related_model._meta
@@ -81,16 +659,136 @@ class RelatedObjectsDescriptor(object):
 
     def get_query_for_field(self, instance, field):
         if self.is_gfk(field):
-            ctype = ContentType.objects.get_for_model(instance)
             return {
-                field.ct_field: ctype,
-                field.fk_field: instance.pk
+                '%s_id' % field.ct_field: content_types.get_id(instance),
+                field.fk_field: self.get_fk_value(instance, field)
             }
         elif isinstance(instance, field.rel.to):
             return {field.name: instance}
 
         raise TypeError(u'Unable to query %s with %s' % (field, instance))
 
+    def get_fk_value(self, obj, field):
+        """
+        The primary key of ``obj`` converted to the type of the column that
+        stores it for the GFK ``field``, e.g. a string for CharField ids
+        """
+        fk_field = self.related_model._meta.get_field(field.fk_field)
+        return fk_field.to_python(obj.pk)
+
+    def group_queries_for_field(self, objs, field):
+        """
+        Group ``objs`` into as few filters on ``field`` as possible -- one per
+        content type when ``field`` is a GFK, otherwise a single ``__in``
+        """
+        groups = {}
+        for obj in objs:
+            query = self.get_query_for_field(obj, field)
+            if self.is_gfk(field):
+                ctype_id = query['%s_id' % field.ct_field]
+                group = groups.setdefault(ctype_id, {
+                    '%s_id' % field.ct_field: ctype_id,
+                    '%s__in' % field.fk_field: [],
+                })
+                group['%s__in' % field.fk_field].append(query[field.fk_field])
+            else:
+                group = groups.setdefault(None, {'%s__in' % field.name: []})
+                group['%s__in' % field.name].append(obj)
+        return list(groups.values())
+
+    def get_object_key(self, obj, field):
+        """
+        Key identifying ``obj`` when it is stored in ``field``, comparable to
+        the output of ``get_connection_key``
+        """
+        if self.is_gfk(field):
+            return (content_types.get_id(obj), self.get_fk_value(obj, field))
+        return obj.pk
+
+    def get_connection_key(self, connection, field):
+        """
+        Key identifying the object ``connection`` stores in ``field``, read
+        from the raw column values so nothing is fetched
+        """
+        if self.is_gfk(field):
+            return (getattr(connection, '%s_id' % field.ct_field),
+                    getattr(connection, field.fk_field))
+        return getattr(connection, field.attname)
+
+    def get_edge(self, connection):
+        """
+        (content type id, object id) of both ends of ``connection``, as a
+        single tuple
+        """
+        return (self.get_connection_key(connection, self.from_field) +
+                self.get_connection_key(connection, self.to_field))
+
+    def get_edge_fields(self):
+        return ['%s_id' % self.from_field.ct_field, self.from_field.fk_field,
+                '%s_id' % self.to_field.ct_field, self.to_field.fk_field]
+
+    @contextmanager
+    def writing(self, using):
+        """
+        Block in which the managers write connections.  When counters are
+        kept it is a transaction, so the counters are updated along with the
+        connections or not at all.
+        """
+        if self.counters:
+            with transaction.atomic(using=using):
+                yield
+        else:
+            yield
+
+    def update_counters(self, added=(), removed=()):
+        """
+        Adjust the stored counters for the ``added`` and ``removed`` edges,
+        as returned by ``get_edge``
+        """
+        if self.counters:
+            RelatedObjectCount.objects.update_counts(
+                self.related_model, added, removed)
+
+    @instrumented
+    def get_counts(self, objs, incoming=False, by_type=False):
+        """
+        Returns a dictionary mapping each of ``objs`` to the stored number of
+        its connections (to it, with ``incoming``), or with ``by_type`` to a
+        dictionary of model -> number of connections.  A single query is
+        issued, whatever the number of objects.
+        """
+        if not self.counters:
+            raise ValueError(u'Counters are not kept for %s.%s' % (
+                self.model_class._meta.object_name, self.name))
+
+        field = self.to_field if incoming else self.from_field
+        objs_by_key = {}
+        for obj in objs:
+            ctype_id, obj_id = self.get_object_key(obj, field)
+            objs_by_key[(ctype_id, u'%s' % obj_id)] = obj
+
+        result = dict((obj, {} if by_type else 0) for obj in objs_by_key.values())
+        if not objs_by_key:
+            return result
+
+        query = Q()
+        for group in self.group_keys(objs_by_key, field):
+            query |= Q(object_type_id=group['%s_id' % field.ct_field],
+                       object_id__in=group['%s__in' % field.fk_field])
+        counts = RelatedObjectCount.objects.filter(
+            query, through_id=content_types.get_id(self.related_model),
+            incoming=incoming).values_list(
+                'object_type_id', 'object_id', 'other_type_id', 'count')
+
+        for ctype_id, obj_id, other_type_id, count in counts:
+            obj = objs_by_key[(ctype_id, obj_id)]
+            if not by_type:
+                result[obj] += count
+            elif count:
+                model_class = content_types.get_model(other_type_id)
+                result[obj][model_class] = result[obj].get(model_class, 0) + count
+        return result
+
     def get_query_from(self, instance):
         return self.get_query_for_field(instance, self.from_field)
 
@@ -102,12 +800,122 @@ class RelatedObjectsDescriptor(object):
         self.model_class = cls
         setattr(cls, self.name, self)
 
+        if self.cache_alias:
+            dispatch_uid = 'genericm2m-cache-%s.%s.%s' % (
+                cls._meta.app_label, cls._meta.model_name, name)
+            for signal in (signals.post_save, signals.post_delete):
+                signal.connect(self.connection_changed, sender=self.related_model,
+                               weak=False, dispatch_uid=dispatch_uid)
+
+        if self.cascade:
+            dispatch_uid = 'genericm2m-cascade-%s.%s.%s' % (
+                cls._meta.app_label, cls._meta.model_name, name)
+            signals.pre_delete.connect(self.object_deleting, sender=cls,
+                                       weak=False, dispatch_uid=dispatch_uid)
+            signals.post_delete.connect(self.object_deleted, sender=cls,
+                                        weak=False, dispatch_uid=dispatch_uid)
+
+    def get_cache_key(self, key):
+        """
+        Cache key under which the connections of the object identified by
+        ``key`` (the output of ``get_object_key``) are stored
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        opts = self.related_model._meta
+        return 'genericm2m:%s.%s:%s:%s' % (
+            opts.app_label, opts.model_name, self.from_field.name,
+            ':'.join('%s' % k for k in key))
+
+    def invalidate_cache(self, *keys):
+        if self.cache_alias and keys:
+            caches[self.cache_alias].delete_many(
+                [self.get_cache_key(key) for key in keys])
+
+    def connection_changed(self, sender, instance, **kwargs):
+        """
+        Signal handler discarding the cached connections of the object on the
+        "from" side of a connection that was saved or deleted
+        """
+        if self.is_gfk(self.from_field):
+            ctype_id = getattr(instance, '%s_id' % self.from_field.ct_field)
+            if ctype_id != content_types.get_id(self.model_class):
+                return
+        self.invalidate_cache(self.get_connection_key(instance, self.from_field))
+
+    def get_deleting(self, using):
+        """
+        Objects of this thread being deleted from the database ``using``, as a
+        pair of dictionaries of pk -> object: those whose connections are
+        still to be deleted and those whose connections already are
+        """
+        state = self.deleting.__dict__
+        if using not in state:
+            state[using] = (OrderedDict(), {})
+        return state[using]
+
+    def object_deleting(self, sender, instance, using, **kwargs):
+        """
+        pre_delete handler.  Django sends pre_delete for all the objects
+        being deleted before deleting any of them, so they are remembered to
+        delete all their connections at once afterwards.
+        """
+        pending, done = self.get_deleting(using)
+        pending[instance.pk] = instance
+        done.pop(instance.pk, None)
+
+    def object_deleted(self, sender, instance, using, **kwargs):
+        """
+        post_delete handler deleting the connections from and to the objects
+        deleted along with ``instance``, when it is the first of them
+        """
+        pending, done = self.get_deleting(using)
+        if done.pop(instance.pk, None) is not None:
+            return
+
+        objs = [instance]
+        pending.pop(instance.pk, None)
+        if pending:
+            # skip objects left over from a deletion that failed
+            existing = set(sender._base_manager.using(using).filter(
+                pk__in=list(pending)).values_list('pk', flat=True))
+            objs.extend(obj for pk, obj in pending.items() if pk not in existing)
+            done.update((obj.pk, obj) for obj in objs[1:])
+            pending.clear()
+
+        self.delete_rows(self.get_connections_of(objs).using(using))
+
+    def get_connections_of(self, objs):
+        """
+        The rows of the through model from or to ``objs`` in its generic
+        fields, matched with one condition per content type and side
+        """
+        query = Q()
+        for field in (self.from_field, self.to_field):
+            if self.is_gfk(field):
+                for group in self.group_queries_for_field(objs, field):
+                    query |= Q(**group)
+
+        queryset = self.related_model._base_manager.all()
+        return queryset.filter(query) if query else queryset.none()
+
     def __get__(self, instance, cls=None):
         if instance is None:
             return self
 
+        # managers are memoized on the instance, keyed by primary key so a
+        # manager created before the instance was saved is never reused
+        cache = instance.__dict__.setdefault(
+            '_genericm2m_managers', RelatedManagerCache())
+        if self in cache:
+            pk, manager = cache[self]
+            if pk == instance.pk:
+                return manager
+
         ManagerClass = type(self.related_model._default_manager)
-        return self.create_manager(instance, ManagerClass)
+        manager = self.create_manager(instance, ManagerClass)
+        cache[self] = (instance.pk, manager)
+        return manager
 
     def __set__(self, instance, value):
         if instance is None:
@@ -121,103 +929,659 @@ class RelatedObjectsDescriptor(object):
                 self.related_model._base_manager.__class__)
 
     def create_manager(self, instance, superclass, cf_from=True):
-        rel_obj = self
         if cf_from:
             core_filters = self.get_query_from(instance)
-            rel_field = self.to_field
         else:
             core_filters = self.get_query_to(instance)
+
+        manager = self.get_manager_class(superclass, cf_from)()
+        manager.instance = instance
+        manager.core_filters = core_filters
+        manager.model = self.related_model
+        manager.descriptor = self
+
+        return manager
+
+    def get_manager_class(self, superclass, cf_from=True):
+        key = (superclass, cf_from)
+        if key not in self.manager_classes:
+            self.manager_classes[key] = self.build_manager_class(
+                superclass, cf_from)
+        return self.manager_classes[key]
+
+    def build_manager_class(self, superclass, cf_from=True):
+        rel_obj = self
+        if cf_from:
+            rel_field = self.to_field
+        else:
             rel_field = self.from_field
         uses_gfk = self.is_gfk(rel_field)
 
-        class RelatedManager(superclass):
-            def get_queryset(self):
+        class RelatedManager(AsyncRelatedManagerMixin, superclass):
+            def get_base_queryset(self):
                 if uses_gfk:
-                    qs = GFKOptimizedQuerySet(self.model, gfk_field=rel_field)
-                    return qs.filter(**(core_filters))
+                    return GFKOptimizedQuerySet(self.model, gfk_field=rel_field,
+                                                descriptor=rel_obj)
                 else:
                     if django.VERSION < (1, 6):
                         method = superclass.get_query_set
                     else:
                         method = superclass.get_queryset
 
-                    return method(self).filter(**(core_filters))
+                    return method(self)
+
+            def get_queryset(self):
+                if cf_from:
+                    try:
+                        return self.instance._prefetched_objects_cache[rel_obj.name]
+                    except (AttributeError, KeyError):
+                        pass
+                return self.get_base_queryset().filter(**(self.core_filters))
 
             if django.VERSION < (1, 6):
                 get_query_set = get_queryset
 
-            def add(self, *objs):
-                for obj in objs:
-                    if not isinstance(obj, self.model):
-                        raise TypeError(u"'%s' instance expected" % self.model._meta.object_name)
-                    if not PY3:
-                        for (k, v) in core_filters.iteritems():
-                            setattr(obj, k, v)
-                    else:
-                        for (k, v) in core_filters.items():
-                            setattr(obj, k, v)
-                    obj.save()
+            def get_prefetch_queryset(self, instances, queryset=None):
+                """
+                Hook for prefetch_related(): fetches the connections of all
+                ``instances`` with one query and, for GFKs, the connected
+                objects with one query per content type
+                """
+                if queryset is None:
+                    queryset = self.get_base_queryset()
+
+                query = Q()
+                for group in rel_obj.group_queries_for_field(instances, rel_obj.from_field):
+                    query |= Q(**group)
+                queryset = queryset.filter(query)
+                if isinstance(queryset, GFKOptimizedQuerySet):
+                    queryset = queryset.prefetch_generic_objects()
+                elif uses_gfk:
+                    queryset = queryset.prefetch_related(rel_field.name)
+
+                return (
+                    queryset,
+                    lambda connection: rel_obj.get_connection_key(connection, rel_obj.from_field),
+                    lambda obj: rel_obj.get_object_key(obj, rel_obj.from_field),
+                    False,
+                    rel_obj.name,
+                )
+
+            def _apply_rel_filters(self, queryset):
+                return queryset.filter(**self.core_filters)
+
+            def _remove_prefetched_objects(self):
+                try:
+                    self.instance._prefetched_objects_cache.pop(rel_obj.name)
+                except (AttributeError, KeyError):
+                    pass
+
+            @instrumented
+            def add(self, *objs, **kwargs):
+                """
+                Attach the given relationship objects to this instance,
+                calling save() on each.  With bulk=True, unsaved objects are
+                written with a single INSERT and saved ones are moved with a
+                single UPDATE instead, bypassing save() and the model signals:
+                only the fields pointing at this instance are written for
+                saved objects, and new ones are left without a primary key on
+                backends which do not return them from bulk inserts.
+                """
+                bulk = kwargs.pop('bulk', False)
+                self._remove_prefetched_objects()
+
+                with rel_obj.writing(self.db):
+                    # saved objects may be moved from other instances, whose
+                    # cached connections and counters go stale as well
+                    stale_keys = [rel_obj.get_object_key(self.instance, rel_obj.from_field)]
+                    moved = []
+                    if rel_obj.cache_alias or rel_obj.counters:
+                        pk_list = [obj.pk for obj in objs if not obj._state.adding]
+                        moved = list(self.model._base_manager.filter(pk__in=pk_list))
+                        stale_keys.extend(
+                            rel_obj.get_connection_key(obj, rel_obj.from_field)
+                            for obj in moved)
+                    for obj in objs:
+                        if not isinstance(obj, self.model):
+                            raise TypeError(u"'%s' instance expected" % self.model._meta.object_name)
+                        if not PY3:
+                            for (k, v) in self.core_filters.iteritems():
+                                setattr(obj, k, v)
+                        else:
+                            for (k, v) in self.core_filters.items():
+                                setattr(obj, k, v)
+                        if not bulk:
+                            obj.save()
+
+                    if bulk:
+                        new_objs = [obj for obj in objs if obj._state.adding]
+                        pk_list = [obj.pk for obj in objs if not obj._state.adding]
+                        if new_objs:
+                            self.model._base_manager.bulk_create(new_objs)
+                        if pk_list:
+                            self.model._base_manager.filter(pk__in=pk_list).update(
+                                **self.core_filters)
+
+                    if rel_obj.counters:
+                        rel_obj.update_counters(
+                            added=[rel_obj.get_edge(obj) for obj in objs],
+                            removed=[rel_obj.get_edge(obj) for obj in moved])
+
+                rel_obj.invalidate_cache(*stale_keys)
             add.alters_data = True
 
+            @instrumented
             def create(self, **kwargs):
-                kwargs.update(core_filters)
-                return super(RelatedManager, self).create(**kwargs)
+                self._remove_prefetched_objects()
+                kwargs.update(self.core_filters)
+                with rel_obj.writing(self.db):
+                    obj = super(RelatedManager, self).create(**kwargs)
+                    if rel_obj.counters:
+                        rel_obj.update_counters(added=[rel_obj.get_edge(obj)])
+                return obj
             create.alters_data = True
 
+            @instrumented
             def get_or_create(self, **kwargs):
-                kwargs.update(core_filters)
-                return super(RelatedManager, self).get_or_create(**kwargs)
+                self._remove_prefetched_objects()
+                kwargs.update(self.core_filters)
+                with rel_obj.writing(self.db):
+                    obj, created = super(RelatedManager, self).get_or_create(**kwargs)
+                    if created and rel_obj.counters:
+                        rel_obj.update_counters(added=[rel_obj.get_edge(obj)])
+                return obj, created
             get_or_create.alters_data = True
 
+            @instrumented
             def remove(self, *objs):
+                self._remove_prefetched_objects()
+                # Are the objs actually part of this descriptor set?  Check
+                # them all with one query before deleting anything
                 for obj in objs:
-                    # Is obj actually part of this descriptor set?
-                    if obj in self.all():
-                        obj.delete()
+                    if not isinstance(obj, self.model):
+                        raise TypeError(u"'%s' instance expected" % self.model._meta.object_name)
+                pk_list = [obj.pk for obj in objs]
+                with rel_obj.writing(self.db):
+                    queryset = self.filter(pk__in=pk_list)
+                    if rel_obj.counters:
+                        edges = dict(
+                            (row[0], row[1:])
+                            for row in queryset.values_list('pk', *rel_obj.get_edge_fields()))
+                        related_pks = set(edges)
                     else:
-                        raise rel_obj.related_model.DoesNotExist(
-                            u"%r is not related to %r." % (obj, instance))
+                        edges = {}
+                        related_pks = set(queryset.values_list('pk', flat=True))
+                    for obj in objs:
+                        if obj.pk is None or obj.pk not in related_pks:
+                            raise rel_obj.related_model.DoesNotExist(
+                                u"%r is not related to %r." % (obj, self.instance))
+                    queryset.delete()
+                    rel_obj.update_counters(removed=edges.values())
             remove.alters_data = True
 
+            @instrumented
             def clear(self):
-                self.all().delete()
+                self._remove_prefetched_objects()
+                with rel_obj.writing(self.db):
+                    if rel_obj.counters:
+                        rel_obj.update_counters(removed=list(
+                            self.all().values_list(*rel_obj.get_edge_fields())))
+                    self.all().delete()
             clear.alters_data = True
 
+            @instrumented
             def connect(self, obj, **kwargs):
                 kwargs.update(rel_obj.get_query_to(obj))
                 connection, created = self.get_or_create(**kwargs)
                 return connection
 
+            @instrumented
+            def disconnect(self, *objs):
+                """
+                Counterpart to connect(), deletes the connections to ``objs``
+                with one query per content type and returns how many were
+                deleted
+                """
+                self._remove_prefetched_objects()
+                deleted = 0
+                with rel_obj.writing(self.db):
+                    for query in rel_obj.group_queries_for_field(objs, rel_obj.to_field):
+                        queryset = self.filter(**query)
+                        if rel_obj.counters:
+                            rel_obj.update_counters(removed=list(
+                                queryset.values_list(*rel_obj.get_edge_fields())))
+                        deleted += queryset.delete()[0]
+                return deleted
+            disconnect.alters_data = True
+
+            @instrumented
+            def generic_objects(self, model=None, missing='raise', orphans=None,
+                                pairs=False, querysets=None):
+                """
+                Shortcut for all().generic_objects().  If the descriptor has a
+                cache, the connections are read from it and only the generic
+                objects are fetched from the database.
+                """
+                queryset = self.all()
+                if not (cf_from and rel_obj.cache_alias) or pairs or \
+                        queryset._result_cache is not None:
+                    return queryset.generic_objects(model, missing, orphans, pairs,
+                                                    querysets)
+
+                cache = caches[rel_obj.cache_alias]
+                cache_key = rel_obj.get_cache_key(
+                    rel_obj.get_object_key(self.instance, rel_obj.from_field))
+                rows = cache.get(cache_key)
+                if rows is None:
+                    rows = list(queryset.values_list(
+                        'pk', '%s_id' % rel_field.ct_field, rel_field.fk_field))
+                    cache.set(cache_key, rows, rel_obj.cache_timeout)
+                return list(queryset.resolve_generic_objects(
+                    rows, model, missing, orphans, querysets))
+
+            @instrumented
+            def is_connected(self, obj):
+                """
+                Whether ``obj`` is connected to this instance, checked with an
+                EXISTS query
+                """
+                return self.filter(**rel_obj.get_query_for_field(obj, rel_field)).exists()
+
+            @instrumented
+            def connected_ids(self, model):
+                """
+                Primary keys of the objects of type ``model`` connected to this
+                instance, without loading any rows
+                """
+                if uses_gfk:
+                    ctype_id = content_types.get_id(model)
+                    return list(self.filter(**{
+                        '%s_id' % rel_field.ct_field: ctype_id,
+                    }).values_list(rel_field.fk_field, flat=True))
+                elif issubclass(model, rel_field.rel.to):
+                    return list(self.values_list(rel_field.attname, flat=True))
+                return []
+
+            @instrumented
+            def count_by_type(self):
+                """
+                Returns a dictionary mapping each model to the number of its
+                objects connected to this instance, using one GROUP BY query
+                """
+                if not uses_gfk:
+                    return {rel_field.rel.to: self.count()}
+
+                ctype_field = '%s_id' % rel_field.ct_field
+                counts = self.order_by().values_list(ctype_field).annotate(
+                    count=Count('pk'))
+
+                result = {}
+                for ctype_id, count in counts:
+                    model_class = content_types.get_model(ctype_id)
+                    result[model_class] = count
+                return result
+
+            @instrumented
+            def counter(self, by_type=False):
+                """
+                The number of connections of this instance read from its
+                counters, see ``RelatedObjectsDescriptor.get_counts``
+                """
+                counts = rel_obj.get_counts([self.instance], not cf_from, by_type)
+                return counts[self.instance]
+
+            @instrumented
+            def paginate_after(self, cursor=None, limit=20):
+                """
+                Keyset pagination over this instance's connections, see
+                ``genericm2m.models.paginate_after``
+                """
+                return paginate_after(self.all(), cursor, limit)
+
+            def get_connections(self, objs, **kwargs):
+                """
+                Map the key of each object in ``objs`` to its existing
+                connection, using one query per content type
+                """
+                connections = {}
+                for query in rel_obj.group_queries_for_field(objs, rel_obj.to_field):
+                    for connection in self.filter(**kwargs).filter(**query):
+                        key = rel_obj.get_connection_key(connection, rel_obj.to_field)
+                        connections.setdefault(key, connection)
+                return connections
+
+            @instrumented
+            def connect_many(self, objs, **kwargs):
+                """
+                Like connect(), but for many objects at once: existing
+                connections are looked up with one query per content type and
+                the missing ones are created with a single INSERT.  Returns
+                the connections in the same order as ``objs``.
+                """
+                self._remove_prefetched_objects()
+                objs = list(objs)
+                connections = self.get_connections(objs, **kwargs)
+
+                missing = OrderedDict()
+                for obj in objs:
+                    key = rel_obj.get_object_key(obj, rel_obj.to_field)
+                    if key not in connections and key not in missing:
+                        attrs = dict(kwargs)
+                        attrs.update(self.core_filters)
+                        attrs.update(rel_obj.get_query_to(obj))
+                        missing[key] = (obj, self.model(**attrs))
+
+                if missing:
+                    new_objs = [connection for obj, connection in missing.values()]
+                    with rel_obj.writing(self.db):
+                        new_objs = self.model._base_manager.bulk_create(new_objs)
+                        if rel_obj.counters:
+                            rel_obj.update_counters(added=[
+                                rel_obj.get_edge(connection) for connection in new_objs])
+                    if any(connection.pk is None for connection in new_objs):
+                        # the backend did not return primary keys, so read
+                        # the new rows back
+                        connections.update(self.get_connections(
+                            [obj for obj, connection in missing.values()],
+                            **kwargs))
+                    else:
+                        for key, (obj, connection) in missing.items():
+                            connections[key] = connection
+
+                    # bulk_create() does not send post_save
+                    rel_obj.invalidate_cache(
+                        rel_obj.get_object_key(self.instance, rel_obj.from_field))
+
+                return [
+                    connections[rel_obj.get_object_key(obj, rel_obj.to_field)]
+                    for obj in objs
+                ]
+            connect_many.alters_data = True
+
             def related_to(self):
-                mgr = rel_obj.create_manager(instance, superclass, False)
-                return mgr.filter(
-                    **rel_obj.get_query_to(instance)
-                )
+                # the reverse manager is already filtered on the "to" side
+                mgr = rel_obj.create_manager(self.instance, superclass, False)
+                return mgr.all()
+
+            @instrumented
+            def related_to_objects(self, model=None, missing='skip',
+                                   querysets=None):
+                """
+                The objects connected to this instance, i.e. the parents of
+                related_to(), fetched with one query per content type
+                """
+                return self.related_to().generic_objects(
+                    model, missing, querysets=querysets)
 
-            def symmetrical(self):
+            def symmetrical(self, union=False):
+                """
+                Connections from or to this instance.  By default this is a
+                single query using OR and DISTINCT, which can be filtered
+                further.  With ``union``, the two sides are queried separately
+                and combined with UNION ALL, so each can use its index; the
+                resulting queryset can be ordered and sliced but not filtered.
+                """
                 if django.VERSION < (1, 6):
                     method = superclass.get_query_set
                 else:
                     method = superclass.get_queryset
-                return method(self).filter(
-                    Q(**rel_obj.get_query_from(instance)) |
-                    Q(**rel_obj.get_query_to(instance))
-                ).distinct()
+                queryset = method(self)
 
-        manager = RelatedManager()
-        manager.core_filters = core_filters
-        manager.model = self.related_model
+                from_q = Q(**rel_obj.get_query_from(self.instance))
+                to_q = Q(**rel_obj.get_query_to(self.instance))
+                if union and hasattr(queryset, 'union') and \
+                        connections[queryset.db].features.supports_select_union:
+                    # connections from the instance to itself are only
+                    # returned by the first query
+                    forward = queryset.filter(from_q).order_by()
+                    reverse = queryset.filter(to_q).exclude(from_q).order_by()
+                    return forward.union(reverse, all=True).order_by(
+                        *self.model._meta.ordering)
 
-        return manager
+                return queryset.filter(from_q | to_q).distinct()
+
+            @instrumented
+            def symmetrical_objects(self, model=None, missing='skip',
+                                    querysets=None):
+                """
+                The objects on the other end of the connections from or to
+                this instance, fetched with one query per direction and one
+                per content type
+                """
+                return rel_obj.traverse([self.instance], 1, 'both', model=model,
+                                        missing=missing, querysets=querysets)
+
+        return RelatedManager
 
     def all(self):
         if self.is_gfk(self.from_field):
-            ctype = ContentType.objects.get_for_model(self.model_class)
-            query = {self.from_field.ct_field: ctype}
+            ctype_id = content_types.get_id(self.model_class)
+            query = {'%s_id' % self.from_field.ct_field: ctype_id}
         else:
             query = {}
         return self.related_model._default_manager.filter(**query)
 
+    def get_traversal_steps(self, direction):
+        if not (self.is_gfk(self.from_field) and self.is_gfk(self.to_field)):
+            raise TypeError(u'Traversal requires GenericForeignKeys on both '
+                            u'sides of %s' % self.related_model._meta.object_name)
+        steps = []
+        if direction in ('forward', 'both'):
+            steps.append((self.from_field, self.to_field))
+        if direction in ('reverse', 'both'):
+            steps.append((self.to_field, self.from_field))
+        if not steps:
+            raise ValueError(u"direction must be one of 'forward', 'reverse' or 'both'")
+        return steps
+
+    @instrumented
+    def reachable_keys(self, objs, depth=1, direction='forward', use_cte=False,
+                       batch_size=500):
+        """
+        Walks the connections outward from ``objs`` for up to ``depth`` hops,
+        following them from parent to object ('forward'), object to parent
+        ('reverse') or 'both'.  Returns an ordered dictionary mapping the
+        (content type id, object id) key of every object reached to the hop
+        it was first reached at, excluding ``objs`` themselves.
+
+        Each hop costs one query per direction (split in batches of
+        ``batch_size`` objects for very wide frontiers).  With ``use_cte``,
+        a single recursive query per ``batch_size`` objects is issued instead
+        on databases supporting it, when walking in one direction.
+        """
+        steps = self.get_traversal_steps(direction)
+        start = [self.get_object_key(obj, self.from_field) for obj in objs]
+        if not start:
+            return OrderedDict()
+
+        db = self.related_model._default_manager.db
+        if use_cte and len(steps) == 1 and \
+                connections[db].vendor in ('postgresql', 'sqlite'):
+            return self.reachable_keys_cte(start, depth, steps[0], db, batch_size)
+
+        visited = OrderedDict((key, 0) for key in start)
+        frontier = list(visited)
+        for hop in range(1, depth + 1):
+            if not frontier:
+                break
+
+            reached = []
+            for src, dst in steps:
+                for i in range(0, len(frontier), batch_size):
+                    query = Q()
+                    for group in self.group_keys(frontier[i:i + batch_size], src):
+                        query |= Q(**group)
+
+                    rows = self.related_model._default_manager.filter(query).order_by()
+                    rows = rows.values_list('%s_id' % dst.ct_field, dst.fk_field).distinct()
+                    for key in rows:
+                        if key not in visited:
+                            visited[key] = hop
+                            reached.append(key)
+            frontier = reached
+
+        for key in start:
+            visited.pop(key, None)
+        return visited
+
+    def group_keys(self, keys, field):
+        """
+        Group (content type id, object id) keys into one filter on the GFK
+        ``field`` per content type
+        """
+        groups = OrderedDict()
+        for ctype_id, obj_id in keys:
+            group = groups.setdefault(ctype_id, {
+                '%s_id' % field.ct_field: ctype_id,
+                '%s__in' % field.fk_field: [],
+            })
+            group['%s__in' % field.fk_field].append(obj_id)
+        return list(groups.values())
+
+    def reachable_keys_cte(self, start, depth, step, db, batch_size=500):
+        visited = OrderedDict()
+        for i in range(0, len(start), batch_size):
+            for key, hop in self.walk_cte(start[i:i + batch_size], depth, step, db):
+                if hop < visited.get(key, hop + 1):
+                    visited[key] = hop
+
+        start = set(start)
+        return OrderedDict(sorted(
+            ((key, hop) for key, hop in visited.items() if key not in start),
+            key=lambda item: item[1]))
+
+    def walk_cte(self, start, depth, step, db):
+        """
+        Yields the (content type id, object id) key and hop of every object
+        reached from the keys ``start`` with one recursive query, seeded by
+        the connections leaving them
+        """
+        if depth < 1:
+            return
+
+        src, dst = step
+        connection = connections[db]
+        opts = self.related_model._meta
+        qn = connection.ops.quote_name
+
+        fk = opts.get_field(dst.fk_field)
+        src_fk = opts.get_field(src.fk_field)
+        columns = {
+            'table': qn(opts.db_table),
+            'src_ct': qn(opts.get_field(src.ct_field).column),
+            'src_fk': qn(src_fk.column),
+            'dst_ct': qn(opts.get_field(dst.ct_field).column),
+            'dst_fk': qn(fk.column),
+        }
+
+        conditions, params = [], []
+        for group in self.group_keys(start, src):
+            obj_ids = group['%s__in' % src.fk_field]
+            conditions.append('(r.%s = %%s AND r.%s IN (%s))' % (
+                columns['src_ct'], columns['src_fk'], ', '.join(['%s'] * len(obj_ids))))
+            params.append(group['%s_id' % src.ct_field])
+            params.extend(src_fk.get_db_prep_value(obj_id, connection)
+                          for obj_id in obj_ids)
+        params.append(depth)
+
+        sql = (
+            'WITH RECURSIVE walk(ctype_id, obj_id, depth) AS ('
+            'SELECT r.%(dst_ct)s, r.%(dst_fk)s, 1 FROM %(table)s r WHERE %(seeds)s UNION '
+            'SELECT r.%(dst_ct)s, r.%(dst_fk)s, w.depth + 1 FROM %(table)s r '
+            'INNER JOIN walk w ON r.%(src_ct)s = w.ctype_id AND r.%(src_fk)s = w.obj_id '
+            'WHERE w.depth < %%s) '
+            'SELECT ctype_id, obj_id, MIN(depth) FROM walk '
+            'GROUP BY ctype_id, obj_id ORDER BY 3'
+        ) % dict(columns, seeds=' OR '.join(conditions))
+
+        cursor = connection.cursor()
+        try:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+
+        for ctype_id, obj_id, hop in rows:
+            yield (ctype_id, fk.to_python(obj_id)), hop
+
+    @instrumented
+    def traverse(self, objs, depth=1, direction='forward', use_cte=False,
+                 model=None, missing='skip', querysets=None):
+        """
+        Returns the objects reached by reachable_keys(), ordered by the number
+        of hops needed to reach them, fetched with one query per content type
+        and optionally restricted to instances of ``model``
+        """
+        keys = self.reachable_keys(objs, depth, direction, use_cte)
+        queryset = GFKOptimizedQuerySet(self.related_model, gfk_field=self.to_field)
+        rows = [(None, ctype_id, obj_id) for ctype_id, obj_id in keys]
+        return list(queryset.resolve_generic_objects(
+            rows, model, missing, querysets=querysets))
+
+    def iter_orphans(self, batch_size=1000):
+        """
+        Walks the rows of the through model in batches of ``batch_size``, one
+        content type of each generic side at a time, checking which of the
+        objects they point at still exist.  Yields a (field, content type id,
+        number of rows scanned, primary keys of the orphaned rows) tuple per
+        batch.
+        """
+        manager = self.related_model._base_manager
+        for field in (self.from_field, self.to_field):
+            if not self.is_gfk(field):
+                continue
+
+            ctype_field = '%s_id' % field.ct_field
+            fk_field = self.related_model._meta.get_field(field.fk_field)
+            ctype_ids = list(manager.order_by(ctype_field).values_list(
+                ctype_field, flat=True).distinct())
+            for ctype_id in ctype_ids:
+                model_class = content_types.get_model(ctype_id)
+                rows = manager.filter(**{ctype_field: ctype_id}).order_by('pk')
+                last_pk = None
+                while True:
+                    batch = rows if last_pk is None else rows.filter(pk__gt=last_pk)
+                    batch = list(batch.values_list('pk', field.fk_field)[:batch_size])
+                    if not batch:
+                        break
+                    last_pk = batch[-1][0]
+
+                    existing = set()
+                    if model_class is not None:
+                        # ids which are not even valid primary keys are orphans
+                        obj_ids = []
+                        for pk, obj_id in batch:
+                            try:
+                                obj_ids.append(model_class._meta.pk.to_python(obj_id))
+                            except ValidationError:
+                                pass
+                        existing = set(
+                            fk_field.to_python(pk)
+                            for pk in model_class._base_manager.filter(
+                                pk__in=obj_ids).values_list('pk', flat=True))
+
+                    yield (field, ctype_id, len(batch),
+                           [pk for pk, obj_id in batch if obj_id not in existing])
+
+    def delete_connections(self, pk_list):
+        """
+        Deletes the rows of the through model with the given primary keys and
+        returns how many were deleted
+        """
+        return self.delete_rows(
+            self.related_model._base_manager.filter(pk__in=pk_list))
+
+    def delete_rows(self, queryset):
+        """
+        Deletes the rows of the through model matched by ``queryset``, keeping
+        the counters in sync, and returns how many were deleted
+        """
+        with self.writing(queryset.db):
+            if self.counters:
+                self.update_counters(removed=list(
+                    queryset.values_list(*self.get_edge_fields())))
+            return queryset.delete()[0]
+
 
 class BaseGFKRelatedObject(models.Model):
     """
@@ -236,6 +1600,46 @@ class BaseGFKRelatedObject(models.Model):
 
     class Meta:
         abstract = True
+        # connections are always looked up by content type *and* id
+        index_together = (
+            ('parent_type', 'parent_id'),
+            ('object_type', 'object_id'),
+        )
+
+
+class BigIntegerGFKRelatedObject(BaseGFKRelatedObject):
+    """
+    A BaseGFKRelatedObject for relating objects whose primary keys do not fit
+    in a 32-bit integer
+    """
+    parent_id = models.BigIntegerField(db_index=True)
+    object_id = models.BigIntegerField(db_index=True)
+
+    class Meta(BaseGFKRelatedObject.Meta):
+        abstract = True
+
+
+class UUIDGFKRelatedObject(BaseGFKRelatedObject):
+    """
+    A BaseGFKRelatedObject for relating objects with UUID primary keys
+    """
+    parent_id = models.UUIDField(db_index=True)
+    object_id = models.UUIDField(db_index=True)
+
+    class Meta(BaseGFKRelatedObject.Meta):
+        abstract = True
+
+
+class CharGFKRelatedObject(BaseGFKRelatedObject):
+    """
+    A BaseGFKRelatedObject storing object ids as strings, which can relate
+    objects with any kind of primary key to one another
+    """
+    parent_id = models.CharField(max_length=255, db_index=True)
+    object_id = models.CharField(max_length=255, db_index=True)
+
+    class Meta(BaseGFKRelatedObject.Meta):
+        abstract = True
 
 
 class RelatedObject(BaseGFKRelatedObject):
@@ -247,8 +1651,125 @@ class RelatedObject(BaseGFKRelatedObject):
     alias = models.CharField(max_length=255, blank=True)
     creation_date = models.DateTimeField(auto_now_add=True)
 
-    class Meta:
+    class Meta(BaseGFKRelatedObject.Meta):
         ordering = ('-creation_date',)
 
     def __unicode__(self):
         return unicode(u'%s related to %s ("%s")' % (self.parent, self.object, self.alias))
+
+
+class RelatedObjectCountManager(models.Manager):
+    def update_counts(self, through, added=(), removed=(), batch_size=500):
+        """
+        Adjust the counters of the objects on both ends of the ``added`` and
+        ``removed`` edges of the ``through`` model, given as (from content
+        type id, from id, to content type id, to id) tuples.  Objects whose
+        counters change by the same amount are updated together, with a few
+        queries per group.
+        """
+        deltas = {}
+        for edges, delta in ((added, 1), (removed, -1)):
+            for from_ctype_id, from_id, to_ctype_id, to_id in edges:
+                for key in ((from_ctype_id, u'%s' % from_id, to_ctype_id, False),
+                            (to_ctype_id, u'%s' % to_id, from_ctype_id, True)):
+                    deltas[key] = deltas.get(key, 0) + delta
+
+        groups = OrderedDict()
+        for (ctype_id, obj_id, other_type_id, incoming), delta in deltas.items():
+            if delta:
+                groups.setdefault(
+                    (ctype_id, other_type_id, incoming, delta), []).append(obj_id)
+
+        through_id = content_types.get_id(through)
+        for (ctype_id, other_type_id, incoming, delta), obj_ids in groups.items():
+            for i in range(0, len(obj_ids), batch_size):
+                batch = obj_ids[i:i + batch_size]
+                counters = self.filter(through_id=through_id, object_type_id=ctype_id,
+                                       other_type_id=other_type_id, incoming=incoming,
+                                       object_id__in=batch)
+                existing = set(counters.values_list('object_id', flat=True))
+                if existing:
+                    counters.update(count=F('count') + delta)
+
+                def new_counter(obj_id):
+                    return self.model(through_id=through_id, object_type_id=ctype_id,
+                                      object_id=obj_id, other_type_id=other_type_id,
+                                      incoming=incoming, count=delta)
+
+                missing = [obj_id for obj_id in batch if obj_id not in existing]
+                if not missing:
+                    continue
+                try:
+                    with transaction.atomic(using=self.db):
+                        self.bulk_create([new_counter(obj_id) for obj_id in missing])
+                except IntegrityError:
+                    # another transaction created some of the counters since
+                    # they were read, so create or update them one at a time
+                    for obj_id in missing:
+                        try:
+                            with transaction.atomic(using=self.db):
+                                new_counter(obj_id).save(force_insert=True, using=self.db)
+                        except IntegrityError:
+                            counters.filter(object_id=obj_id).update(
+                                count=F('count') + delta)
+
+    def recompute(self, descriptor, batch_size=1000):
+        """
+        Replace the counters of the through model of ``descriptor`` with ones
+        computed from its rows, reading the grouped rows and inserting the
+        counters in batches of ``batch_size``.  Returns the number of counters
+        written.
+        """
+        through = descriptor.related_model
+        through_id = content_types.get_id(through)
+        steps = (
+            (False, descriptor.from_field, descriptor.to_field),
+            (True, descriptor.to_field, descriptor.from_field),
+        )
+
+        written = 0
+        with transaction.atomic(using=self.db):
+            self.filter(through_id=through_id).delete()
+            for incoming, field, other in steps:
+                rows = through._base_manager.order_by().values_list(
+                    '%s_id' % field.ct_field, field.fk_field,
+                    '%s_id' % other.ct_field).annotate(count=Count('pk')).iterator()
+                while True:
+                    batch = list(islice(rows, batch_size))
+                    if not batch:
+                        break
+
+                    self.bulk_create([
+                        self.model(through_id=through_id, object_type_id=ctype_id,
+                                   object_id=u'%s' % obj_id, other_type_id=other_type_id,
+                                   incoming=incoming, count=count)
+                        for ctype_id, obj_id, other_type_id, count in batch
+                    ])
+                    written += len(batch)
+        return written
+
+
+class RelatedObjectCount(models.Model):
+    """
+    The number of connections stored in a through model from an object (to
+    it, if ``incoming``) per content type on the other end, kept up to date
+    for descriptors created with counters=True
+    """
+    through = models.ForeignKey(ContentType, related_name='+')
+    object_type = models.ForeignKey(ContentType, related_name='+')
+    object_id = models.CharField(max_length=255)
+    other_type = models.ForeignKey(ContentType, related_name='+')
+    incoming = models.BooleanField(default=False)
+    count = models.IntegerField(default=0)
+
+    objects = RelatedObjectCountManager()
+
+    class Meta:
+        unique_together = (
+            ('through', 'object_type', 'object_id', 'other_type', 'incoming'),
+        )
+
+    def __unicode__(self):
+        return unicode(u'%s connections %s %s:%s' % (
+            self.count, 'to' if self.incoming else 'from', self.object_type_id,
+            self.object_id))
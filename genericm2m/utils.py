@@ -1,4 +1,4 @@
-from genericm2m.models import RelatedObjectsDescriptor
+from genericm2m.models import RelatedObjectsDescriptor, get_models
 
 
 def monkey_patch(model_class, name='related', descriptor=None):
@@ -6,3 +6,31 @@ def monkey_patch(model_class, name='related', descriptor=None):
     rel_obj.contribute_to_class(model_class, name)
     setattr(model_class, name, rel_obj)
     return True
+
+
+def get_descriptors(labels=None):
+    """
+    Returns a dictionary mapping each through model used by the descriptors of
+    the installed models to one of them, preferring those which keep counters.
+    ``labels`` ("app_label.ModelName") restricts it to some through models.
+    """
+    descriptors = {}
+    for model in get_models():
+        for attr in model.__dict__.values():
+            if isinstance(attr, RelatedObjectsDescriptor) and (
+                    attr.counters or attr.related_model not in descriptors):
+                descriptors[attr.related_model] = attr
+
+    if not labels:
+        return descriptors
+
+    by_label = dict(
+        ('%s.%s' % (model._meta.app_label, model._meta.model_name), descriptor)
+        for model, descriptor in descriptors.items())
+    selected = {}
+    for label in labels:
+        if label.lower() not in by_label:
+            raise LookupError("No descriptor uses '%s'" % label)
+        descriptor = by_label[label.lower()]
+        selected[descriptor.related_model] = descriptor
+    return selected
@@ -32,6 +32,13 @@ try:
 except AttributeError:
     pass
 
+def runbenchmarks(*args):
+    parent = dirname(abspath(__file__))
+    sys.path.insert(0, parent)
+    from genericm2m.genericm2m_tests.benchmarks import main
+    regressions = main(args, sys.stdout)
+    sys.exit(1 if regressions else 0)
+
 def runtests(*test_args):
     if not test_args:
         if sys.version_info[0] > 2:
@@ -46,4 +53,8 @@ def runtests(*test_args):
     sys.exit(failures)
 
 if __name__ == '__main__':
-    runtests(*sys.argv[1:])
+    if 'bench' in sys.argv:
+        sys.argv.remove('bench')
+        runbenchmarks(*sys.argv[1:])
+    else:
+        runtests(*sys.argv[1:])